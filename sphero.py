@@ -30,6 +30,10 @@ group.add_argument("-q", "--quiet", action="store_true")
 parser.add_argument("-s", "--stat", help="n")
 parser.add_argument("-d", "--disable", action="store_true", help="")
 parser.add_argument("-c", "--config", action="store_true", help="start Config Mode")
+parser.add_argument("--source", default=0, help="camera index or video file")
+parser.add_argument("--headless", action="store_true", help="no OpenCV windows")
+parser.add_argument("--preview", type=int, default=0, help="MJPEG debug preview on this local port")
+parser.add_argument("--record-track", default=None, help="save the detected track to this json file")
 args = parser.parse_args()
 
 #Arg Disable Logging
@@ -47,7 +51,9 @@ if args.verbosity == 0:
 
 #Start Threads
 #OpenCv Thread. Exit cvThread.threadExit = True
-cvThread = sphero_opencv.Opencv(kwargs={'config': args.config})
+cvThread = sphero_opencv.Opencv(kwargs={'config': args.config, 'source': args.source,
+                                        'headless': args.headless, 'preview': args.preview,
+                                        'recordTrack': args.record_track})
 cvThread.setDaemon(True)
 
 #If config mode
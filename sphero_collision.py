@@ -0,0 +1,132 @@
+import collections
+import logging
+import math
+import time
+
+from sphero_driver import sphero_driver
+from sphero_config import loadConfig
+
+# Settings missing in config/collision.json
+DEFAULT_CONFIG = {'method': 1, 'xThreshold': 100, 'xSpeed': 100, 'yThreshold': 100, 'ySpeed': 100, 'deadTime': 10,
+                  'pushSpeed': 255, 'pushTime': 0.5, 'evadeSpeed': 200, 'evadeTime': 0.6}
+
+
+class Collision(object):
+    """Sphero collision module:
+        - Configures the collision detection of Sphero from config/collision.json
+        - Queues the collision events of the driver for the tactics thread
+        - Measures the time from the event to the reaction
+    """
+
+    def __init__(self, control, configName='collision', maxEvents=16):
+        """
+        :param control: sphero_control.Control of the robot
+        :param configName: name of the json file in config/
+        :param maxEvents: queued events, the oldest are dropped if nobody reacts
+        """
+        self.logger = logging.getLogger('sphero.collision')
+        self.control = control
+        self.config = dict(DEFAULT_CONFIG)
+        self.config.update(loadConfig(configName) or {})
+        # deque append / popleft are atomic - no lock between driver and tactics thread
+        self.events = collections.deque(maxlen=maxEvents)
+        self.receivedCount = 0
+        self.droppedCount = 0
+        self.skippedCount = 0
+        # Seconds from the received event to the reaction command
+        self.latencies = collections.deque(maxlen=100)
+
+    def enable(self):
+        """Turns on the collision detection, call after connect
+        :return: True if sent"""
+        sphero = self.control.sphero
+        if not sphero.is_connected:
+            return False
+        sphero.add_async_callback(sphero_driver.IDCODE['COLLISION'], self.onCollision)
+        sphero.config_collision_detect(self.config['method'],
+                                       self.config['xThreshold'], self.config['xSpeed'],
+                                       self.config['yThreshold'], self.config['ySpeed'],
+                                       self.config['deadTime'], None)
+        return True
+
+    def disable(self):
+        """Turns off the collision detection"""
+        if self.control.sphero.is_connected:
+            self.control.sphero.config_collision_detect(0, 0, 0, 0, 0, 0, None)
+        self.events.clear()
+
+    def onCollision(self, event):
+        """Async callback of the driver, runs in its reader thread"""
+        event['received'] = time.time()
+        self.receivedCount += 1
+        if len(self.events) == self.events.maxlen:
+            self.droppedCount += 1
+        self.events.append(event)
+
+    def poll(self):
+        """Newest queued collision, older ones are outdated by it
+        :return: event dict or None"""
+        event = None
+        while True:
+            try:
+                newer = self.events.popleft()
+            except IndexError:
+                return event
+            if event is not None:
+                self.skippedCount += 1
+            event = newer
+
+    def reacted(self, event):
+        """Records the latency of the reaction to event, call after the command was given"""
+        self.latencies.append(time.time() - event['received'])
+
+    def impactHeading(self, event, heading):
+        """Direction the impact came from
+        :param event: collision event
+        :param heading: heading of Sphero when hit (0 - 359)
+        :return: heading in degrees 0 - 359"""
+        # X is to the right, Y straight ahead of the ball
+        return int(heading + math.degrees(math.atan2(event['X'], event['Y']))) % 360
+
+    def getStats(self):
+        """Collision metrics
+        :return: dict with the received, dropped (queue full) and skipped (outdated) events
+        and the last / mean / max reaction latency"""
+        latencies = list(self.latencies)
+        return dict(received=self.receivedCount, dropped=self.droppedCount, skipped=self.skippedCount,
+                    latencyLast=latencies[-1] if latencies else None,
+                    latencyMean=sum(latencies) / len(latencies) if latencies else None,
+                    latencyMax=max(latencies) if latencies else None)
+
+
+def main():
+    "Only for Development Tests - reaction latency against the emulator"
+    import sphero_control
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.DEBUG)
+    control = sphero_control.Control(reconnect=False)
+    control.connect('emu://')
+    collision = Collision(control)
+    collision.enable()
+    # the detection is configured once a later command is answered
+    control.sphero.ping(True).result()
+    control.roll(100, 0)
+    missed = 0
+    for i in range(20):
+        control.sphero.bt.emulator.inject_collision(0, -1000)
+        # control ticks of the tactics thread
+        deadline = time.time() + 1.0
+        while time.time() < deadline:
+            event = collision.poll()
+            if event:
+                control.stop()
+                collision.reacted(event)
+                break
+            time.sleep(0.001)
+        else:
+            missed += 1
+        time.sleep(0.15)
+    print collision.getStats(), 'missed:', missed
+    control.disconnect()
+
+if __name__ == '__main__':
+    main()
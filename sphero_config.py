@@ -0,0 +1,19 @@
+import json
+import os
+
+
+def loadConfig(name):
+    """
+    load Configuration from json
+    :param name: Filename
+    :return: Configuration-Data
+    """
+    # Set Path
+    path = 'config/' + name + '.json'
+    # load json-File
+    if os.path.isfile(path):
+        with open(path, 'rb') as fp:
+            data = json.load(fp)
+
+        return data
+    return None
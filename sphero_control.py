@@ -1,22 +1,62 @@
+import collections
 import logging
+import time
 
 from sphero_driver import sphero_driver
+from sphero_driver import sphero_macro
+from sphero_driver import sphero_sensors
 
 
 class Control(object):
     """Controls and connects to Sphero.
-    Is a more abstract interface to the Sphero library"""
+    Is a more abstract interface to the Sphero library
 
+    Keeps a shadow copy of the last values sent to the actuators and
+    skips writes that wouldn't change anything. Every value is sent
+    again after refreshInterval seconds, in case a packet got lost."""
 
-    def __init__(self, openCv=None):
+
+    def __init__(self, openCv=None, speedTolerance=0, headingTolerance=0, refreshInterval=0.5, sphero=None, reconnect=True,
+                 latencyInterval=1.0, defaultLatency=0.03):
+        """
+        :param speedTolerance: speed change (0 - 255) that is not sent
+        :param headingTolerance: heading change in degrees that is not sent
+        :param refreshInterval: seconds after which an unchanged value is sent again
+        :param sphero: driver to use, e.g. a robot of a SpheroPool - default a new Sphero
+        :param reconnect: bring a dropped link back and remember the found devices,
+        only for a driver that can reconnect (not a pool AsyncSphero)
+        :param latencyInterval: seconds between the pings that measure the command latency
+        :param defaultLatency: command latency in seconds until the first ping returned
+        """
         self.logger = logging.getLogger('sphero.control')
-        self.sphero = sphero_driver.Sphero()
+        self.sphero = sphero if sphero is not None else sphero_driver.Sphero()
         self.openCv = openCv
+        # SensorHistory of the data stream, set by connect
+        self.sensors = None
+        if reconnect and self.sphero.can_reconnect and self.sphero.reconnector is None:
+            self.sphero.device_cache = sphero_driver.DeviceCache()
+            self.sphero.reconnector = sphero_driver.Reconnector(self.sphero.device_cache)
+
+        # Shadow of the actuator state: name -> (value, time sent)
+        self.shadow = {}
+        self.speedTolerance = speedTolerance
+        self.headingTolerance = headingTolerance
+        self.refreshInterval = refreshInterval
+        self.sentCount = 0
+        self.skippedCount = 0
+        # a macro drives Sphero, direct commands have to abort it
+        self.macroRunning = False
+        # Round trip times of the latency pings
+        self.latencyInterval = latencyInterval
+        self.defaultLatency = defaultLatency
+        self.pingTimes = collections.deque(maxlen=20)
+        self.lastPing = 0
 
     def connect(self, mac=None):
         """Connect to Sphero
         mac = 1 - Connect to Sphero 1
         mac = 2 - Connect to Sphero 2
+        mac = 'emu://' or 'tcp://host:port' - Connect to an emulated Sphero
         
         Return: True if connect was successful
         """
@@ -24,8 +64,12 @@ class Control(object):
         
         if self.sphero.is_connected:
             return True
+        self.shadow.clear()
+        self.macroRunning = False
         if mac is None:
             ret = self.sphero.connect()
+        elif isinstance(mac, basestring):
+            ret = self.sphero.connect(mac)
         else:
             ret = self.sphero.connect(macID[mac])
 
@@ -33,6 +77,8 @@ class Control(object):
             self.logger.warning("Not Connected")
         else:
             self.sphero.set_raw_data_strm(40, 1, 0, False)
+            # 400Hz / 40 = 10 samples per second
+            self.sensors = sphero_sensors.SensorHistory.attach(self.sphero, rate=10)
             self.sphero.start()
             return True
         return False
@@ -48,7 +94,7 @@ class Control(object):
         :param static: Save color"""
         color = ((255,0,0), (0,255,0), (0,0,0), (255,255,255))
         col = color[colorId]
-        if self.sphero.is_connected:
+        if self.sphero.is_connected and self.isChanged('color', (col, static)):
             self.sphero.set_rgb_led(col[0],col[1],col[2],int(static),False)
 
 
@@ -56,7 +102,7 @@ class Control(object):
         """Set the rotation rate for the new heading
         param: rate: 0 - 255"""
 
-        if self.sphero.is_connected:
+        if self.sphero.is_connected and self.isChanged('rotationRate', rate):
             self.sphero.set_rotation_rate(rate,None)
         
 
@@ -72,29 +118,116 @@ class Control(object):
         :param speed: 0-255 value representing 0-max speed of the sphero.
         :param heading: heading in degrees from 0 to 359.
         """
-        if self.sphero.is_connected:
+        if self.sphero.is_connected and self.macroRunning:
+            self.abortMacro()
+        if self.sphero.is_connected and self.isChanged('roll', (speed, heading), self.isRollSimilar):
             self.sphero.roll(speed, heading, 1, None)
         
+    def getRoll(self):
+        """Speed and heading of the last roll sent
+        :return: (speed, heading), (0, 0) before the first roll"""
+        return self.shadow.get('roll', ((0, 0), None))[0]
+
     def setHeading(self,heading):
         if self.sphero.is_connected:
+            # New reference direction - the last roll heading is meaningless now
+            self.shadow.pop('roll', None)
             self.sphero.set_heading(heading, None)
 
     def stop(self):
         """Stops Sphero"""
+        if self.sphero.is_connected and self.macroRunning:
+            self.abortMacro()
         if self.sphero.is_connected:
+            # Always sent, but the next roll must not be skipped
+            self.shadow['roll'] = ((0, 0), time.time())
+            self.sentCount += 1
             self.sphero.roll(0,0,0,None)
     
     def setStabilation(self, stabilation=True):
         """Enables or disables Spheros stabilizations system
         param: stabilation: bool"""
-        if self.sphero.is_connected:
+        if self.sphero.is_connected and self.isChanged('stabilation', stabilation):
             self.sphero.set_stablization(stabilation, None)
         
     def setBackled(self, brightness):
         """Controls the brightness of Spheros back LED
         param: brightness: 0 - 255"""
-        if self.sphero.is_connected:
+        if self.sphero.is_connected and self.isChanged('backled', brightness):
             self.sphero.set_back_led(brightness, None)
+
+    def runMacro(self, macro):
+        """Upload a macro and start it, the manoeuvre runs on Sphero without further commands
+        :param macro: sphero_macro.Macro, e.g. sphero_macro.circle(...)"""
+        if self.sphero.is_connected:
+            self.sphero.save_temp_macro(macro.compile(), None)
+            self.sphero.run_macro(sphero_macro.TEMP_MACRO, None)
+            self.sentCount += 2
+            self.macroRunning = True
+            # the macro changes speed and heading
+            self.shadow.pop('roll', None)
+
+    def abortMacro(self):
+        """Stops a running macro"""
+        if self.sphero.is_connected and self.macroRunning:
+            self.sphero.abort_macro(None)
+            self.sentCount += 1
+        self.macroRunning = False
+
+    def isChanged(self, name, value, isSimilar=None):
+        """Check the value against the shadow state and update it
+        :param name: actuator name
+        :param value: new value
+        :param isSimilar: function(old, new) -> True if new needn't be sent, default equality
+        :return: True if the value has to be sent"""
+        now = time.time()
+        last = self.shadow.get(name)
+        if last is not None and now - last[1] < self.refreshInterval:
+            if (isSimilar(last[0], value) if isSimilar else last[0] == value):
+                self.skippedCount += 1
+                return False
+        self.shadow[name] = (value, now)
+        self.sentCount += 1
+        return True
+
+    def isRollSimilar(self, old, new):
+        """True if speed and heading are within the tolerance band"""
+        headingDiff = abs(old[1] - new[1]) % 360
+        headingDiff = min(headingDiff, 360 - headingDiff)
+        return abs(old[0] - new[0]) <= self.speedTolerance and headingDiff <= self.headingTolerance
+
+    def getCommandLatency(self):
+        """Estimated seconds from a command given now until Sphero acts on it:
+        half the median round trip of the recent pings plus the mean wait in the transmit queue.
+        Sends a ping with response every latencyInterval seconds, the reader thread records its round trip
+        :return: seconds"""
+        now = time.time()
+        if self.sphero.is_connected and now - self.lastPing >= self.latencyInterval:
+            self.lastPing = now
+            self.sphero.ping(True).add_done_callback(self.onPing)
+        pingTimes = sorted(self.pingTimes)
+        if not pingTimes:
+            return self.defaultLatency
+        return pingTimes[len(pingTimes) / 2] / 2 + self.sphero.tx_scheduler.stats()['staleness_mean']
+
+    def onPing(self, response):
+        """Done callback of the latency ping, runs in the reader thread"""
+        if response.exception() is None and response.rtt is not None:
+            self.pingTimes.append(response.rtt)
+
+    def getLinkStats(self):
+        """Link metrics
+        :return: dict with the writes sent and skipped by the shadow state,
+        the skipped share, the transmit stats of the driver and the reconnects"""
+        stats = self.sphero.tx_scheduler.stats()
+        if self.sphero.reconnector is not None:
+            stats['reconnect'] = self.sphero.reconnector.stats()
+        total = self.sentCount + self.skippedCount
+        stats['controlSent'] = self.sentCount
+        stats['controlSkipped'] = self.skippedCount
+        stats['controlSkippedRatio'] = float(self.skippedCount) / total if total else 0.0
+        stats['commandLatency'] = self.getCommandLatency()
+        return stats
        
 def main():
     "Only for Development Tests"
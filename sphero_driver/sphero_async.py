@@ -0,0 +1,484 @@
+"""
+Event loop driver for Sphero.
+
+SpheroLoop is a select based reactor: one thread does the non-blocking
+reads and writes of every registered AsyncSphero, so several robots
+and the control loop share a process without a reader and a writer
+thread per link. It speaks the same REQ / IDCODE protocol as
+sphero_driver.Sphero, commands return SpheroResponse futures and the
+async packets are read from EventStream iterators::
+
+    loop = SpheroLoop()
+    loop.start()
+    sphero = AsyncSphero(loop)
+    sphero.connect(mac)
+    print sphero.get_power_state(True).result()
+    for event in sphero.events(sphero_driver.IDCODE['COLLISION']):
+        ...
+"""
+import os
+import sys
+import time
+import errno
+import fcntl
+import select
+import socket
+import logging
+import threading
+import collections
+
+import sphero_driver
+
+
+def is_would_block(error):
+    return getattr(error, 'errno', None) in (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+class EventStream(object):
+    """
+    Bounded, iterable queue of async events. When it is full the oldest
+    event is dropped, a slow consumer never holds up the loop.
+    """
+
+    def __init__(self, maxlen=256):
+        self._events = collections.deque(maxlen=maxlen)
+        self._cond = threading.Condition(threading.Lock())
+        self._closed = False
+        self.dropped = 0
+
+    def put(self, event):
+        with self._cond:
+            if len(self._events) == self._events.maxlen:
+                self.dropped += 1
+            self._events.append(event)
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """
+        :param timeout: seconds to wait, None waits until an event arrives
+        :return: the oldest event, None on timeout or when closed
+        """
+        with self._cond:
+            if not self._events and not self._closed:
+                self._cond.wait(timeout)
+            if self._events:
+                return self._events.popleft()
+            return None
+
+    def close(self):
+        """Ends the iteration once the queued events are read"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def __iter__(self):
+        while True:
+            with self._cond:
+                while not self._events and not self._closed:
+                    self._cond.wait()
+                if not self._events:
+                    return
+                event = self._events.popleft()
+            yield event
+
+
+class AsyncSphero(sphero_driver.Sphero):
+    """
+    Sphero whose I/O runs in a SpheroLoop instead of its own reader and
+    writer threads. Don't wait for a response in a callback, callbacks
+    run on the loop thread. A dropped link is closed, not reconnected.
+    """
+    can_reconnect = False
+
+    def __init__(self, loop, target_name='Sphero'):
+        sphero_driver.Sphero.__init__(self, target_name)
+        self.loop = loop
+        # unsent rest of a partly written packet
+        self._tx_rest = None
+        self._streams = []
+        self._closing = False
+        self._closed = threading.Event()
+
+    def start_io(self):
+        self._closing = False
+        self._closed.clear()
+        self.bt.setblocking(False)
+        self.tx_scheduler.notify = self.loop.wakeup
+        self.loop.add(self)
+
+    def start(self):
+        """Nothing to start, the reads run in the loop"""
+        pass
+
+    def fileno(self):
+        return self.bt.fileno()
+
+    def events(self, callback_type, maxlen=256):
+        """
+        Iterator over the async packets of one type, replaces the
+        callback of that type.
+
+        :param callback_type: IDCODE of the packets.
+        :param maxlen: events kept for a slow consumer.
+        :return: EventStream of the parsed packets.
+        """
+        stream = EventStream(maxlen)
+        self._streams.append(stream)
+        self.add_async_callback(callback_type, stream.put)
+        return stream
+
+    def wants_write(self):
+        """
+        :return: 0 if there is something to write now, the seconds until
+        a rate limited packet is due, or None.
+        """
+        if self._tx_rest is not None:
+            return 0.0
+        return self.tx_scheduler.ready_in()
+
+    def handle_read(self):
+        try:
+            n = self.framer.fill(self.bt, 1024)
+        except IOError as error:
+            if is_would_block(error):
+                return
+            n = 0
+        if not n:
+            self.handle_close()
+            return
+        self.dispatch()
+
+    def handle_write(self):
+        if self._tx_rest is None:
+            item = self.tx_scheduler.poll()[0]
+            if item is None:
+                return
+            msg, pending = item
+            if pending is not None:
+                pending.sent = time.time()
+            self._tx_rest = msg
+        try:
+            n = self.bt.send(self._tx_rest)
+        except IOError as error:
+            if not is_would_block(error):
+                self.handle_close()
+            return
+        self._tx_rest = self._tx_rest[n:] or None
+        if self._closing and self.wants_write() is None:
+            self.handle_close()
+
+    def handle_close(self):
+        """Called by the loop when the link is gone or drained on disconnect"""
+        if self.loop.remove(self):
+            self.is_connected = False
+            self.bt.close()
+            self.fail_pending("disconnected")
+            for stream in self._streams:
+                stream.close()
+            self._closed.set()
+
+    def disconnect(self, timeout=1.0):
+        """
+        Closes the link once the queued packets (e.g. a stop) are sent.
+
+        :param timeout: seconds to wait for the queue to drain.
+        """
+        self._closing = True
+        if self.wants_write() is None:
+            self.handle_close()
+        else:
+            self.loop.wakeup()
+            if not self._closed.wait(timeout):
+                self.handle_close()
+        return self.is_connected
+
+
+class SpheroLoop(threading.Thread):
+    """
+    Runs the reads and writes of any number of AsyncSphero links in one
+    thread with select.
+    """
+
+    def __init__(self, name='Thread-SpheroLoop'):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.shutdown = False
+        self.logger = logging.getLogger('sphero.loop')
+        self._spheros = set()
+        self._lock = threading.Lock()
+        # writing to the pipe wakes up select
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        for fd in (self._wakeup_r, self._wakeup_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def add(self, sphero):
+        with self._lock:
+            self._spheros.add(sphero)
+        self.wakeup()
+
+    def remove(self, sphero):
+        """
+        :return: True if the sphero was registered
+        """
+        with self._lock:
+            if sphero not in self._spheros:
+                return False
+            self._spheros.discard(sphero)
+        self.wakeup()
+        return True
+
+    def spheros(self):
+        with self._lock:
+            return list(self._spheros)
+
+    def wakeup(self):
+        try:
+            os.write(self._wakeup_w, 'x')
+        except OSError as error:
+            # pipe full - a wakeup is pending anyway
+            if not is_would_block(error):
+                raise
+
+    def stop(self):
+        self.shutdown = True
+        self.wakeup()
+
+    def run(self):
+        while not self.shutdown:
+            spheros = self.spheros()
+            writers = []
+            timeout = None
+            for sphero in spheros:
+                wait = sphero.wants_write()
+                if wait == 0:
+                    writers.append(sphero)
+                elif wait is not None and (timeout is None or wait < timeout):
+                    timeout = wait
+
+            try:
+                readable, writable, _ = select.select([self._wakeup_r] + spheros, writers, [], timeout)
+            except (select.error, socket.error, IOError, ValueError):
+                # a link was closed under us by disconnect on another thread
+                self._prune(spheros)
+                continue
+
+            if self._wakeup_r in readable:
+                readable.remove(self._wakeup_r)
+                try:
+                    while os.read(self._wakeup_r, 512):
+                        pass
+                except OSError:
+                    pass
+
+            for sphero in readable:
+                self._handle(sphero, sphero.handle_read)
+            for sphero in writable:
+                self._handle(sphero, sphero.handle_write)
+
+        for sphero in self.spheros():
+            sphero.handle_close()
+
+    def _prune(self, spheros):
+        """Closes the spheros whose socket can't be selected any more, the others go on"""
+        for sphero in spheros:
+            try:
+                select.select([sphero], [], [], 0)
+            except (select.error, socket.error, IOError, ValueError):
+                self._handle(sphero, sphero.handle_close)
+
+    def _handle(self, sphero, handler):
+        # one misbehaving link or callback must not stop the others
+        try:
+            handler()
+        except Exception:
+            self.logger.exception("Error on %s", sphero.name)
+
+
+class SpheroPool(object):
+    """
+    Fleet of Spheros driven by one SpheroLoop. Every robot keeps its own
+    transmit scheduler, so a busy robot doesn't delay the others.
+    """
+
+    def __init__(self, loop=None):
+        self.loop = loop if loop is not None else SpheroLoop()
+        if not self.loop.is_alive():
+            self.loop.start()
+        self.robots = collections.OrderedDict()
+        self._connected = dict()
+
+    def connect(self, name, address, max_rate=None):
+        """
+        Connects a robot.
+
+        :param name: name of the robot in the pool.
+        :param address: Bluetooth address or tcp:// / emu:// URI.
+        :param max_rate: coalesced commands per second for this robot.
+        :return: the connected AsyncSphero or None.
+        """
+        sphero = AsyncSphero(self.loop)
+        sphero.name = 'Sphero-' + str(name)
+        sphero.tx_scheduler.max_rate = max_rate
+        if not sphero.connect(address):
+            return None
+        self.robots[name] = sphero
+        self._connected[name] = time.time()
+        return sphero
+
+    def __getitem__(self, name):
+        return self.robots[name]
+
+    def __iter__(self):
+        return iter(self.robots.values())
+
+    def __len__(self):
+        return len(self.robots)
+
+    def disconnect(self, name=None):
+        """Disconnects one robot, all if name is None"""
+        names = [name] if name is not None else list(self.robots)
+        for key in names:
+            self.robots.pop(key).disconnect()
+            self._connected.pop(key, None)
+
+    def stop(self):
+        """Disconnects all robots and stops the loop"""
+        self.disconnect()
+        self.loop.stop()
+        self.loop.join(1.0)
+
+    def robot_stats(self, name):
+        """
+        :return: dict with the transmit (tx) and receive (rx) stats, the
+        receive throughput and the mean response round trip time
+        """
+        sphero = self.robots[name]
+        elapsed = max(time.time() - self._connected[name], 1e-9)
+        rx = sphero.framer.stats()
+        return dict(tx=sphero.tx_scheduler.stats(), rx=rx,
+                    rx_packets_per_second=rx['packets'] / elapsed,
+                    rx_bytes_per_second=rx['bytes_received'] / elapsed,
+                    rtt_mean=sphero.rtt_sum / sphero.rtt_count if sphero.rtt_count else None,
+                    rtt_histogram=sphero.get_rtt_histogram())
+
+    def stats(self):
+        """
+        :return: dict with the stats of every robot (robots) and their
+        sums / means over the pool (total)
+        """
+        robots = dict((name, self.robot_stats(name)) for name in self.robots)
+        rtt_sum = sum(sphero.rtt_sum for sphero in self.robots.values())
+        rtt_count = sum(sphero.rtt_count for sphero in self.robots.values())
+        total = dict(robots=len(robots), rtt_mean=rtt_sum / rtt_count if rtt_count else None)
+        for key in ('rx_packets_per_second', 'rx_bytes_per_second'):
+            total[key] = sum(stats[key] for stats in robots.values())
+        for key in ('sent', 'merged', 'dropped', 'bytes_sent', 'bytes_per_second'):
+            total['tx_' + key] = sum(stats['tx'][key] for stats in robots.values())
+        for key in ('packets', 'crc_errors', 'framing_errors'):
+            total['rx_' + key] = sum(stats['rx'][key] for stats in robots.values())
+        return dict(robots=robots, total=total)
+
+
+def check_responses(pool):
+    """Commands resolve their futures with the response data"""
+    sphero = pool.connect('responses', 'emu://responses')
+    assert sphero is not None, "no connection"
+    assert sphero.ping(True).result() == '', "ping"
+    assert sphero.get_power_state(True).result() == '\x01\x02\x02\xd0\x00\x10\x00\x00', "power state"
+    sphero.set_rgb_led(10, 20, 30, 0, None)
+    assert sphero.get_rgb_led(True).result() == '\x0a\x14\x1e', "rgb after set"
+    pool.disconnect('responses')
+
+
+def check_events(pool):
+    """DATA_STRM and COLLISION packets come out of the event streams"""
+    sphero = pool.connect('events', 'emu://events')
+    samples = sphero.events(sphero_driver.IDCODE['DATA_STRM'])
+    collisions = sphero.events(sphero_driver.IDCODE['COLLISION'])
+    sphero.set_raw_data_strm(4, 1, 0, True).result()
+    for i in range(5):
+        sample = samples.get(1.0)
+        assert sample is not None, "no DATA_STRM sample"
+        assert sample.shape == (1, len(sphero.mask_list)), "sample shape"
+    sphero.config_collision_detect(1, 100, 100, 100, 100, 10, True).result()
+    sphero.bt.emulator.inject_collision(0, 1000)
+    event = collisions.get(1.0)
+    assert event is not None and event['Y'] == 1000, "collision event"
+    pool.disconnect('events')
+    # the iteration ends with the link
+    assert samples._closed and collisions._closed, "streams not closed"
+
+
+def check_pool(pool, robots=4, pings=50):
+    """Several robots stream and answer pings from several threads at once"""
+    names = ['pool%d' % i for i in range(robots)]
+    for name in names:
+        pool.connect(name, 'emu://' + name).set_raw_data_strm(4, 1, 0, None)
+    errors = []
+
+    def ping(name):
+        try:
+            for i in range(pings):
+                pool[name].ping(True).result()
+        except sphero_driver.SpheroError as error:
+            errors.append(error)
+    threads = [threading.Thread(target=ping, args=(name,)) for name in names]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10.0)
+    assert not errors, "ping errors: %s" % errors[:3]
+    stats = pool.stats()
+    assert all(stats['robots'][name]['rx']['packets'] > pings for name in names), "packets per robot"
+    for name in names:
+        pool.disconnect(name)
+
+
+def check_disconnect(pool):
+    """A stop queued right before disconnect is still sent"""
+    sphero = pool.connect('drain', 'emu://drain')
+    sphero.roll(100, 0, 1, None)
+    sphero.roll(0, 0, 0, None)
+    pool.disconnect('drain')
+    stats = sphero.tx_scheduler.stats()
+    assert stats['sent'] == stats['queued'] - stats['dropped'], "queued packets not sent: %s" % stats
+
+
+def check_closed_link(pool):
+    """A link closed under the loop is removed, the other robots go on"""
+    dead = pool.connect('dead', 'emu://dead')
+    alive = pool.connect('alive', 'emu://alive')
+
+    def closed():
+        raise socket.error(errno.EBADF, "Bad file descriptor")
+    dead.fileno = closed
+    pool.loop.wakeup()
+    assert alive.ping(True).result() == '', "ping of the other robot"
+    assert pool.loop.is_alive(), "loop ended"
+    assert dead not in pool.loop.spheros(), "dead link still registered"
+    pool.robots.pop('dead')
+    pool.disconnect('alive')
+
+
+def main():
+    """
+    Only for Development Tests - the AsyncSphero and SpheroLoop checks
+    against emulated Spheros on socketpairs (emu://).
+    """
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.WARNING)
+    pool = SpheroPool()
+    failed = 0
+    for check in (check_responses, check_events, check_pool, check_disconnect, check_closed_link):
+        start = time.time()
+        try:
+            check(pool)
+            result = "ok"
+        except (AssertionError, sphero_driver.SpheroError) as error:
+            failed += 1
+            result = "FAIL: %s" % error
+        print "%-18s %6.3fs  %s" % (check.__name__, time.time() - start, result)
+    pool.stop()
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
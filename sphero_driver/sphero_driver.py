@@ -31,12 +31,22 @@
 # ***********************************************************
 # author: Melonee Wise
 
+import os
 import sys
+import json
+import time
+import random
+import bisect
+import select
+import logging
+import socket
 import struct
 import operator
 import threading
+import collections
 
 import bluetooth
+import numpy as np
 
 
 # These are the message response code that can be return by Sphero.
@@ -68,6 +78,9 @@ IDCODE = dict(
     MACRO_MARKERS=chr(0x06),  # Macro markers
     COLLISION=chr(0x07))  # Collision detected
 
+# MRSP name for a response code
+MRSP_NAME = dict((value, key) for key, value in MRSP.iteritems())
+
 RECV = dict(
     ASYNC=[chr(0xff), chr(0xfe)],
     SYNC=[chr(0xff), chr(0xff)])
@@ -117,6 +130,34 @@ REQ = dict(
     CMD_GET_MACRO_STATUS=[0x02, 0x56],
     CMD_SET_MACRO_STATUS=[0x02, 0x57])
 
+# command name for the DID and CID of a packet
+REQ_NAME = dict((tuple(value), key) for key, value in REQ.iteritems() if key.startswith('CMD_'))
+
+# SOP1, SOP2 (without response), DID, CID of every command and the
+# share of DID + CID in the checksum
+PACKET_HEAD = dict((tuple(value), (bytearray(REQ['WITHOUT_RESPONSE'] + value), value[0] + value[1]))
+                   for key, value in REQ.iteritems() if key.startswith('CMD_'))
+
+# configuration re-applied after a reconnect
+RESTORE = frozenset(tuple(REQ[name]) for name in (
+    'CMD_SET_DATA_STRM', 'CMD_CFG_COL_DET', 'CMD_SET_STABILIZ', 'CMD_SET_ROTATION_RATE',
+    'CMD_SET_RGB_LED', 'CMD_SET_BACK_LED', 'CMD_SET_PWR_NOTIFY'))
+
+# commands that only set a value, a newer one makes a queued one obsolete
+COALESCE = frozenset(tuple(REQ[name]) for name in (
+    'CMD_ROLL', 'CMD_SET_HEADING', 'CMD_SET_RGB_LED', 'CMD_SET_BACK_LED', 'CMD_SET_ROTATION_RATE'))
+
+# commands that move Sphero, a stop drops them from the transmit queue
+# (the temporary macro is only uploaded to be run right away)
+MOTION = frozenset(tuple(REQ[name]) for name in (
+    'CMD_ROLL', 'CMD_BOOST', 'CMD_SET_RAW_MOTORS', 'CMD_RUN_MACRO', 'CMD_SAVE_TEMP_MACRO'))
+
+# upper bounds in seconds of the round trip time histogram buckets
+RTT_BUCKETS = (0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, float('inf'))
+
+# DLEN of an async packet is a 16-bit word, a response's a single byte
+MAX_DLEN = 0xffff
+
 STRM_MASK1 = dict(
     GYRO_H_FILTERED=0x00000001,
     GYRO_M_FILTERED=0x00000002,
@@ -159,16 +200,67 @@ STRM_MASK2 = dict(
     VELOCITY_Y=0x00800000)
 
 
+class DeviceCache(object):
+    """
+    Addresses and channels of the Spheros found before, stored as json
+    so a reconnect or the next start doesn't need a Bluetooth scan. The
+    addresses belong to the host, by default they are kept in the home
+    directory and not in the repository.
+    """
+
+    def __init__(self, path='~/.sphero_devices.json'):
+        path = os.path.expanduser(path)
+        self.path = path
+        self._lock = threading.Lock()
+        self.devices = dict()
+        if os.path.isfile(path):
+            try:
+                with open(path, 'rb') as fp:
+                    self.devices = json.load(fp)
+            except ValueError:
+                self.devices = dict()
+
+    def remember(self, name, address, port):
+        with self._lock:
+            self.devices[address] = dict(name=name, port=port, seen=time.time())
+            try:
+                with open(self.path, 'wb') as fp:
+                    json.dump(self.devices, fp)
+            except IOError:
+                pass
+
+    def lookup(self, target_name):
+        """
+    :return: list of (address, port) of the devices whose name starts\
+    with target_name, the most recently seen first.
+    """
+        with self._lock:
+            found = [(device['seen'], address, device['port']) for address, device in self.devices.iteritems()
+                     if device['name'].startswith(target_name)]
+        return [(address, port) for seen, address, port in sorted(found, reverse=True)]
+
+
 class BTInterface(object):
-    def __init__(self, target_name='Sphero', port=1):
+    def __init__(self, target_name='Sphero', port=1, cache=None):
         self.target_name = target_name
         self.port = port
+        self.cache = cache
         self.found_device = False
         self.tries = 0
         self.target_address = None
         self.sock = None
 
     def connect(self, macaddr=None):
+        if not macaddr and self.cache is not None:
+            # try the known devices before the slow scan
+            for address, port in self.cache.lookup(self.target_name):
+                sys.stdout.write("Connect to known device %s...." % address)
+                self.port = port
+                if self._open(address):
+                    self.found_device = True
+                    self.target_address = address
+                    return True
+
         if not macaddr:
             sys.stdout.write("Searching for devices....")
             sys.stdout.flush()
@@ -201,6 +293,9 @@ class BTInterface(object):
             self.target_address = macaddr
             bdaddr = macaddr
 
+        return self._open(bdaddr)
+
+    def _open(self, bdaddr):
         try:
             self.sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
             self.sock.connect((bdaddr, self.port))
@@ -210,19 +305,564 @@ class BTInterface(object):
             return False
         sys.stdout.write("Paired with Sphero.\n")
         sys.stdout.flush()
+        if self.cache is not None:
+            self.cache.remember(self.target_name, bdaddr, self.port)
         return True
 
     def send(self, data):
-        self.sock.send(data)
+        return self.sock.send(data)
 
     def recv(self, num_bytes):
         return self.sock.recv(num_bytes)
 
+    def fileno(self):
+        return self.sock.fileno()
+
+    def setblocking(self, flag):
+        self.sock.setblocking(flag)
+
+    def recv_into(self, buf, num_bytes):
+        # the bluez socket has no recv_into, fall back to one copy
+        if hasattr(self.sock, 'recv_into'):
+            return self.sock.recv_into(buf, num_bytes)
+        data = self.sock.recv(num_bytes)
+        buf[:len(data)] = data
+        return len(data)
+
     def close(self):
         self.sock.close()
 
 
+class SocketInterface(object):
+    """
+    Same interface as BTInterface over a plain socket, for an emulated
+    Sphero:
+
+    * tcp://host:port - SpheroEmulator server (or anything speaking the\
+      Sphero protocol) on TCP.
+    * emu://name - in-process SpheroEmulator on a socketpair.
+    """
+
+    def __init__(self):
+        self.target_address = None
+        self.sock = None
+        self.emulator = None
+
+    def connect(self, uri):
+        scheme, _, rest = uri.partition('://')
+        try:
+            if scheme == 'emu':
+                import sphero_emulator
+                self.sock, remote = socket.socketpair()
+                self.emulator = sphero_emulator.SpheroEmulator(remote, name=rest or 'Sphero-EMU')
+                self.emulator.start()
+            else:
+                host, _, port = rest.rpartition(':')
+                self.sock = socket.create_connection((host, int(port)))
+                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except (socket.error, ValueError) as error:
+            sys.stdout.write(str(error))
+            sys.stdout.flush()
+            return False
+        self.target_address = uri
+        return True
+
+    def send(self, data):
+        return self.sock.send(data)
+
+    def recv(self, num_bytes):
+        return self.sock.recv(num_bytes)
+
+    def recv_into(self, buf, num_bytes):
+        return self.sock.recv_into(buf, num_bytes)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def setblocking(self, flag):
+        self.sock.setblocking(flag)
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+        if self.emulator is not None:
+            self.emulator.stop()
+
+
+def mask_fields(strm_mask, mask):
+    """
+    Names of the fields of a STRM_MASK1 / STRM_MASK2 mask in the order
+    they are streamed.
+    """
+    sorted_strm = sorted(strm_mask.iteritems(), key=operator.itemgetter(1), reverse=True)
+    # create a list containing the keys that are part of the mask
+    return [key for key, value in sorted_strm if value & mask]
+
+
+def open_interface(address, target_name='Sphero', cache=None):
+    """
+    Interface for an address: SocketInterface for tcp:// and emu://
+    URIs, BTInterface for anything else.
+    """
+    if address and address.startswith(('tcp://', 'emu://')):
+        return SocketInterface()
+    return BTInterface(target_name, cache=cache)
+
+
+class Reconnector(object):
+    """
+    Brings back a dropped link: tries the last address and then the
+    cached ones, with jittered exponential backoff between the rounds.
+    The Sphero re-applies its stream, LED, stabilization and collision
+    configuration once the link is back.
+    """
+
+    def __init__(self, cache=None, base_delay=0.25, max_delay=10.0, max_tries=None):
+        """
+    :param cache: DeviceCache with the known addresses.
+    :param base_delay: seconds before the second round, doubles per round.
+    :param max_delay: upper limit of the delay.
+    :param max_tries: rounds before giving up, None tries forever.
+    """
+        self.cache = cache
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_tries = max_tries
+        # metrics
+        self.drops = 0
+        self.recovered = 0
+        self.failed = 0
+        self.attempts = 0
+        self.recover_times = collections.deque(maxlen=100)
+
+    def delay(self, attempt):
+        """Backoff before round attempt, jittered by up to -50%"""
+        return min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+    def reconnect(self, sphero, address):
+        """
+    Reopens the link of sphero, called by its reader thread.
+
+    :param address: address of the dropped link.
+    :return: True if the link is back.
+    """
+        self.drops += 1
+        start = time.time()
+        addresses = [address]
+        if self.cache is not None:
+            addresses += [known for known, port in self.cache.lookup(sphero.target_name) if known != address]
+        attempt = 0
+        while not sphero.shutdown and (self.max_tries is None or attempt < self.max_tries):
+            for known in addresses:
+                self.attempts += 1
+                if sphero.shutdown:
+                    break
+                if sphero.reopen(known):
+                    self.recovered += 1
+                    self.recover_times.append(time.time() - start)
+                    return True
+            time.sleep(self.delay(attempt))
+            attempt += 1
+        self.failed += 1
+        return False
+
+    def stats(self):
+        """
+    :return: dict with the drops, recovered and failed reconnects, the\
+    connect attempts and the last / mean / max time to recover.
+    """
+        times = list(self.recover_times)
+        return dict(drops=self.drops, recovered=self.recovered, failed=self.failed, attempts=self.attempts,
+                    recover_last=times[-1] if times else None,
+                    recover_mean=sum(times) / len(times) if times else None,
+                    recover_max=max(times) if times else None)
+
+
+class SpheroError(RuntimeError):
+    """
+    A synchronous command failed, code is the MRSP response code or
+    None if no response was received.
+    """
+
+    def __init__(self, command, message, code=None):
+        RuntimeError.__init__(self, "%s: %s" % (command, message))
+        self.command = command
+        self.code = code
+
+
+class SpheroTimeout(SpheroError):
+    """No response to a synchronous command within the timeout"""
+
+
+class SpheroResponse(object):
+    """
+    Future for the response to a command sent with response=True.
+    It is resolved by the reader thread when the response with the
+    same SEQ arrives.
+    """
+
+    def __init__(self, sphero, command, seq):
+        self.sphero = sphero
+        self.command = command
+        self.seq = seq
+        # set by the writer thread when the packet goes out
+        self.sent = time.time()
+        self.rtt = None
+        self._event = threading.Event()
+        self._data = None
+        self._error = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._event.is_set()
+
+    def add_done_callback(self, callback):
+        """
+    Calls callback(response) once the response is resolved, right away
+    if it already is. Runs on the reader thread, don't block in it.
+    """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def set_result(self, data):
+        self._data = data
+        self._resolve()
+
+    def set_error(self, error):
+        self._error = error
+        self._resolve()
+
+    def _resolve(self):
+        with self._lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            # on the reader thread, an exception must not end it
+            self.sphero.call_callback(callback, self)
+
+    def exception(self):
+        """The error of a resolved response or None"""
+        return self._error
+
+    def result(self, timeout=None):
+        """
+    Waits for the response.
+
+    :param timeout: seconds to wait, default is Sphero.response_timeout.
+    :return: data payload of the response as string.
+    :raises SpheroTimeout: no response in time.
+    :raises SpheroError: Sphero returned an error code.
+    """
+        if timeout is None:
+            timeout = self.sphero.response_timeout
+        if not self._event.wait(timeout):
+            self.sphero.cancel_response(self)
+            raise SpheroTimeout(self.command, "no response after %.3fs" % timeout)
+        if self._error is not None:
+            raise self._error
+        return self._data
+
+
+class TxScheduler(object):
+    """
+    Transmit queue between send() and the writer thread.
+
+    Packets of the COALESCE commands are kept once per command, a newer
+    one replaces the queued one and moves to the end, and they go out
+    at most max_rate times per second. Everything else is sent in order
+    and first flushes the queued coalesced packets ahead of it, so
+    coalescing never reorders commands. Urgent packets skip the queue
+    and throw away the queued value of the same command. A stop is
+    urgent and also drops the queued motion packets, they would undo
+    it once sent after it.
+    """
+
+    def __init__(self, max_rate=None):
+        # coalesced packets per second, None for as fast as the link goes
+        self.max_rate = max_rate
+        self._cond = threading.Condition(threading.Lock())
+        self._urgent = collections.deque()
+        self._fifo = collections.deque()
+        # (DID, CID) -> newest item of that command
+        self._latest = collections.OrderedDict()
+        self._next_latest = 0.0
+        self._closed = False
+        # called after put, e.g. to wake up an event loop
+        self.notify = None
+        # counters
+        self.queued = 0
+        self.sent = 0
+        self.merged = 0
+        self.dropped = 0
+        self.coalesced_sent = 0
+        self.bytes_sent = 0
+        self.started = time.time()
+        self.staleness_sum = 0.0
+        self.staleness_max = 0.0
+
+    def put(self, msg, pending=None, key=None, urgent=False, motion=False, stop=False):
+        """
+    Queues a packet.
+
+    :param msg: packed packet.
+    :param pending: SpheroResponse waiting for the answer or None.
+    :param key: (DID, CID) if the packet may be coalesced.
+    :param urgent: send before anything else.
+    :param motion: the packet moves Sphero, see MOTION.
+    :param stop: urgent, drops the queued motion packets, their\
+    responses fail with a SpheroError.
+    """
+        coalesced = key is not None and not (urgent or stop)
+        item = (msg, pending, time.time(), motion, coalesced)
+        cancelled = []
+        with self._cond:
+            self.queued += 1
+            if stop:
+                cancelled = [queued for queued in self._fifo if queued[3]]
+                self._fifo = collections.deque(queued for queued in self._fifo if not queued[3])
+                for latest in [latest for latest, queued in self._latest.iteritems() if queued[3]]:
+                    cancelled.append(self._latest.pop(latest))
+                self.dropped += len(cancelled)
+            if urgent or stop:
+                if key is not None and self._latest.pop(key, None) is not None:
+                    self.dropped += 1
+                self._urgent.append(item)
+            elif coalesced:
+                if self._latest.pop(key, None) is not None:
+                    self.merged += 1
+                self._latest[key] = item
+            else:
+                # the coalesced packets queued before it go out before it
+                self._fifo.extend(self._latest.itervalues())
+                self._latest.clear()
+                self._fifo.append(item)
+            self._cond.notify()
+        for queued in cancelled:
+            if queued[1] is not None:
+                queued[1].sphero.cancel_response(queued[1])
+                queued[1].set_error(SpheroError(queued[1].command, "cancelled by a stop"))
+        if self.notify is not None:
+            self.notify()
+
+    def get(self):
+        """
+    Blocks until the next packet may be sent.
+
+    :return: (msg, pending) or None once closed and drained.
+    """
+        with self._cond:
+            while True:
+                item, wait = self._pop()
+                if item is not None:
+                    return item
+                if self._closed and wait is None:
+                    return None
+                self._cond.wait(wait)
+
+    def poll(self):
+        """
+    Non-blocking get.
+
+    :return: ((msg, pending) or None, seconds until the next coalesced\
+    packet is due or None if nothing is queued).
+    """
+        with self._cond:
+            return self._pop()
+
+    def _pop(self):
+        # called with the lock held
+        if self._urgent:
+            item = self._urgent.popleft()
+        elif self._fifo:
+            item = self._fifo.popleft()
+        elif self._latest:
+            now = time.time()
+            wait = self._next_latest - now
+            if wait > 0 and not self._closed:
+                return None, wait
+            item = self._latest.popitem(last=False)[1]
+            if self.max_rate:
+                self._next_latest = now + 1.0 / self.max_rate
+        else:
+            return None, None
+        if item[4]:
+            staleness = time.time() - item[2]
+            self.coalesced_sent += 1
+            self.staleness_sum += staleness
+            self.staleness_max = max(self.staleness_max, staleness)
+        self.sent += 1
+        self.bytes_sent += len(item[0])
+        return (item[0], item[1]), 0.0
+
+    def ready_in(self):
+        """
+    :return: 0 if a packet may be sent now, the seconds until one may\
+    be sent, or None if nothing is queued.
+    """
+        with self._cond:
+            if self._urgent or self._fifo:
+                return 0.0
+            if self._latest:
+                return max(0.0, self._next_latest - time.time())
+            return None
+
+    def close(self):
+        """The writer stops after the queued packets are sent"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self.notify is not None:
+            self.notify()
+
+    def stats(self):
+        """
+    :return: dict with the queued, sent, merged (replaced by a newer\
+    value) and dropped (cancelled by an urgent packet or a stop)\
+    packet counts, the bytes sent and bytes per second since start,\
+    and the mean and max time in seconds a coalesced value waited.
+    """
+        with self._cond:
+            mean = self.staleness_sum / self.coalesced_sent if self.coalesced_sent else 0.0
+            elapsed = max(time.time() - self.started, 1e-9)
+            return dict(queued=self.queued, sent=self.sent, merged=self.merged, dropped=self.dropped,
+                        bytes_sent=self.bytes_sent, bytes_per_second=self.bytes_sent / elapsed,
+                        staleness_mean=mean, staleness_max=self.staleness_max)
+
+
+class PacketFramer(object):
+    """
+    Splits the byte stream coming from Sphero into packets.
+
+    The bytes are read straight into a preallocated bytearray; the read
+    cursor only moves forward and the unread tail is moved back to the
+    front when the buffer runs full. Packets are handed out as
+    memoryviews into the buffer, they are valid until the next fill.
+
+    Packets with a bad checksum or start bytes are counted and skipped,
+    the cursor then moves to the next 0xff 0xff / 0xff 0xfe boundary.
+    A longer DLEN than max_length is taken as corrupted, so a broken
+    length byte can't stall the stream waiting for kilobytes.
+    set_data_strm raises max_length to the DATA_STRM packet length of
+    the configured mask and frames.
+    """
+
+    def __init__(self, size=4096, max_length=2048):
+        self.max_length = max_length
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        # unread bytes are buf[start:end]
+        self.start = 0
+        self.end = 0
+        # counters
+        self.packets_ok = 0
+        self.crc_errors = 0
+        self.framing_errors = 0
+        self.bytes_skipped = 0
+        self.bytes_received = 0
+
+    def fill(self, bt, num_bytes):
+        """
+    Reads at most num_bytes from the interface into the buffer.
+
+    :param bt: interface providing recv_into.
+    :param num_bytes: maximum number of bytes to read.
+    :return: number of bytes read, 0 if the link was closed.
+    """
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif len(self.buf) - self.end < num_bytes and self.start > 0:
+            pending = self.end - self.start
+            self.buf[:pending] = self.buf[self.start:self.end]
+            self.start, self.end = 0, pending
+        num_bytes = min(num_bytes, len(self.buf) - self.end)
+        n = bt.recv_into(self.view[self.end:], num_bytes)
+        self.end += n
+        self.bytes_received += n
+        return n
+
+    def packets(self):
+        """
+    Generator over the complete, valid packets in the buffer.
+
+    :return: yields (SOP2, packet) with packet being a memoryview of the
+    whole packet including the header and the checksum.
+    """
+        buf = self.buf
+        while self.end - self.start >= 5:
+            start = self.start
+            sop2 = buf[start + 1]
+            if buf[start] != 0xff or sop2 not in (0xff, 0xfe):
+                self.framing_errors += 1
+                self.resync(start + 1)
+                continue
+            if sop2 == 0xff:
+                data_length = buf[start + 4]
+            else:
+                data_length = (buf[start + 3] << 8) + buf[start + 4]
+            if data_length == 0 or data_length > self.max_length:
+                # there is always at least the checksum
+                self.framing_errors += 1
+                self.resync(start + 1)
+                continue
+            size = 5 + data_length
+            if self.end - start < size:
+                # the remainder of the packet isn't here yet
+                if size > len(buf):
+                    self._grow(size)
+                break
+            # modulo 256 sum of the bytes after SOP2 bit inverted
+            if ~sum(buf[start + 2:start + size - 1]) & 0xff != buf[start + size - 1]:
+                self.crc_errors += 1
+                self.resync(start + 1)
+                continue
+            self.start = start + size
+            self.packets_ok += 1
+            yield sop2, self.view[start:start + size]
+
+    def resync(self, pos):
+        """
+    Skips to the next possible packet start at or after pos. A single
+    trailing 0xff is kept, its SOP2 may still be coming.
+    """
+        buf = self.buf
+        while True:
+            pos = buf.find('\xff', pos, self.end)
+            if pos < 0 or pos + 1 == self.end or buf[pos + 1] in (0xff, 0xfe):
+                break
+            pos += 1
+        if pos < 0:
+            pos = self.end
+        self.bytes_skipped += pos - self.start
+        self.start = pos
+
+    def stats(self):
+        """
+    :return: dict with the valid packets, checksum and framing errors,\
+    the number of bytes skipped while resynchronizing and received.
+    """
+        return dict(packets=self.packets_ok, crc_errors=self.crc_errors, framing_errors=self.framing_errors,
+                    bytes_skipped=self.bytes_skipped, bytes_received=self.bytes_received)
+
+    def _grow(self, size):
+        pending = self.end - self.start
+        buf = bytearray(max(size, 2 * len(self.buf)))
+        buf[:pending] = self.view[self.start:self.end]
+        self.buf = buf
+        self.view = memoryview(buf)
+        self.start, self.end = 0, pending
+
+
 class Sphero(threading.Thread):
+    # run() brings a dropped link back with the reconnector
+    can_reconnect = True
+
     def __init__(self, target_name='Sphero'):
         threading.Thread.__init__(self)
         self.target_name = target_name
@@ -232,45 +872,116 @@ class Sphero(threading.Thread):
         self.mask_list = None
         self.stream_mask1 = None
         self.stream_mask2 = None
+        # per mask configuration layout of one DATA_STRM frame
+        self.strm_struct = None
+        self.strm_dtype = np.dtype('>i2')
+        self.stream_frames = 1
+        self.logger = logging.getLogger('sphero.driver')
+        # DATA_STRM packets of another mask, exceptions in callbacks
+        self.strm_mismatched = 0
+        self.callback_errors = 0
         self.seq = 0
-        self.raw_data_buf = []
-        self._communication_lock = threading.Lock()
+        self.framer = PacketFramer()
+        # packets waiting for the writer thread
+        self.tx_scheduler = TxScheduler()
+        self._writer = None
         self._async_callback_dict = dict()
         self._sync_callback_dict = dict()
         self._sync_callback_queue = []
+        # SEQ -> SpheroResponse of the commands waiting for a response
+        self._pending = dict()
+        self._pending_lock = threading.Lock()
+        self.response_timeout = 1.0
+        # command name -> counts per RTT_BUCKETS bucket
+        self.rtt_histogram = dict()
+        self.rtt_sum = 0.0
+        self.rtt_count = 0
+        # set to a Reconnector to bring a dropped link back
+        self.reconnector = None
+        self.device_cache = None
+        # (DID, CID) -> last packet of the RESTORE commands
+        self._restore = collections.OrderedDict()
+        self._link_up = threading.Event()
 
     def connect(self, macaddr=None):
-        self.bt = BTInterface(self.target_name)
+        """
+    :param macaddr: Bluetooth address, None to search for a Sphero, or\
+    a tcp:// / emu:// URI of an emulated Sphero (see SocketInterface).
+    """
+        self.bt = open_interface(macaddr, self.target_name, self.device_cache)
         self.is_connected = self.bt.connect(macaddr)
         if self.is_connected:
+            self._link_up.set()
+            self.start_io()
             return True
 
         return False
 
+    def reopen(self, address):
+        """
+    Opens a new link after the old one dropped and queues the last
+    configuration commands again before anything else.
+
+    :return: True if connected.
+    """
+        bt = open_interface(address, self.target_name, self.device_cache)
+        if not bt.connect(address):
+            return False
+        self.bt = bt
+        self.framer = PacketFramer(len(self.framer.buf), self.framer.max_length)
+        self.is_connected = True
+        for packet in self._restore.values():
+            self.tx_scheduler.put(packet, None, None, True)
+        self._link_up.set()
+        return True
+
+    def start_io(self):
+        """
+    Starts the writer thread after connecting. The reader is this
+    thread (start), the two own one direction of the socket each, so
+    neither has to wait for the other.
+    """
+        self._writer = threading.Thread(target=self._write_loop, name=self.name + '-writer')
+        self._writer.daemon = True
+        self._writer.start()
+
     def inc_seq(self):
         self.seq += 1
         if self.seq > 0xff:
             self.seq = 0
 
     def pack_cmd(self, req, cmd):
+        """
+    Packs a command into a complete packet, see send for the format.
+    The head comes from PACKET_HEAD and the checksum is its cached sum
+    plus SEQ, DLEN and the data. SOP2 is set by send.
+
+    :param req: DID and CID of the command.
+    :param cmd: list of data bytes.
+    :return: packet as bytearray.
+    """
         self.inc_seq()
-        # print req + [self.seq] + [len(cmd)+1] + cmd
-        return req + [self.seq] + [len(cmd) + 1] + cmd
+        head, head_sum = PACKET_HEAD[(req[0], req[1])]
+        n = len(cmd)
+        msg = bytearray(7 + n)
+        msg[:4] = head
+        msg[4] = self.seq
+        msg[5] = n + 1
+        msg[6:6 + n] = cmd
+        # modulo 256 sum of DID through data bit inverted
+        msg[6 + n] = ~(head_sum + self.seq + n + 1 + sum(cmd)) & 0xff
+        return msg
 
     def data2hexstr(self, data):
         return ' '.join([("%02x" % ord(d)) for d in data])
 
     def create_mask_list(self, mask1, mask2):
         # save the mask
-        sorted_STRM1 = sorted(STRM_MASK1.iteritems(), key=operator.itemgetter(1), reverse=True)
-        # create a list containing the keys that are part of the mask
-        self.mask_list1 = [key for key, value in sorted_STRM1 if value & mask1]
-
-        sorted_STRM2 = sorted(STRM_MASK2.iteritems(), key=operator.itemgetter(1), reverse=True)
-        # create a list containing the keys that are part of the mask
-        self.mask_list2 = [key for key, value in sorted_STRM2 if value & mask2]
+        self.mask_list1 = mask_fields(STRM_MASK1, mask1)
+        self.mask_list2 = mask_fields(STRM_MASK2, mask2)
         self.mask_list = self.mask_list1 + self.mask_list2
-
+        # layout of one frame, every field is a signed 16-bit word
+        self.strm_struct = struct.Struct('>%dh' % len(self.mask_list))
 
     def add_async_callback(self, callback_type, callback):
         self._async_callback_dict[callback_type] = callback
@@ -284,6 +995,24 @@ class Sphero(threading.Thread):
     def remove_sync_callback(self, callback_type):
         del self._sync_callback_dict[callback_type]
 
+    def cancel_response(self, pending):
+        """Stops waiting for the response of a pending command"""
+        with self._pending_lock:
+            if self._pending.get(pending.seq) is pending:
+                del self._pending[pending.seq]
+
+    def get_rtt_histogram(self, command=None):
+        """
+    Round trip times of the synchronous commands.
+
+    :param command: command name e.g. 'CMD_PING', None for all.
+    :return: list of (upper bound in seconds, count) per bucket, or a\
+    dict of those lists by command name.
+    """
+        if command is not None:
+            return zip(RTT_BUCKETS, self.rtt_histogram.get(command, [0] * len(RTT_BUCKETS)))
+        return dict((name, zip(RTT_BUCKETS, counts)) for name, counts in self.rtt_histogram.iteritems())
+
     def clamp(self, n, minn, maxn):
         return max(min(maxn, n), minn)
 
@@ -294,7 +1023,7 @@ class Sphero(threading.Thread):
 
     :param response: request response back from Sphero.
     """
-        self.send(self.pack_cmd(REQ['CMD_PING'], []), response)
+        return self.send(self.pack_cmd(REQ['CMD_PING'], []), response)
 
     def get_version(self, response):
         """
@@ -303,7 +1032,7 @@ class Sphero(threading.Thread):
 
     :param response: request response back from Sphero.
     """
-        self.send(self.pack_cmd(REQ['CMD_VERSION'], []), response)
+        return self.send(self.pack_cmd(REQ['CMD_VERSION'], []), response)
 
     def set_device_name(self, name, response):
         """
@@ -316,7 +1045,7 @@ class Sphero(threading.Thread):
     :param name: 48 character name.
     :param response: request response back from Sphero.
     """
-        self.send(self.pack_cmd(REQ['CMD_SET_BT_NAME'], [name]), response)
+        return self.send(self.pack_cmd(REQ['CMD_SET_BT_NAME'], [name]), response)
 
     def get_bt_name(self, response):
         """
@@ -328,7 +1057,7 @@ class Sphero(threading.Thread):
 
     :param response: request response back from Sphero.
     """
-        self.send(self.pack_cmd(REQ['CMD_GET_BT_NAME'], []), response)
+        return self.send(self.pack_cmd(REQ['CMD_GET_BT_NAME'], []), response)
 
     def set_auto_reconnect(self, enable, time, response):
         """
@@ -346,7 +1075,7 @@ class Sphero(threading.Thread):
     enable auto reconnect mode
     :param response: request response back from Sphero.
     """
-        self.send(self.pack_cmd(REQ['CMD_SET_AUTO_RECONNECT'], [enable, time]), response)
+        return self.send(self.pack_cmd(REQ['CMD_SET_AUTO_RECONNECT'], [enable, time]), response)
 
     def get_auto_reconnect(self, response):
         """
@@ -355,7 +1084,7 @@ class Sphero(threading.Thread):
 
     :param response: request response back from Sphero.
     """
-        self.send(self.pack_cmd(REQ['CMD_GET_AUTO_RECONNECT'], []), reponse)
+        return self.send(self.pack_cmd(REQ['CMD_GET_AUTO_RECONNECT'], []), response)
 
     def get_power_state(self, response):
         """
@@ -364,7 +1093,7 @@ class Sphero(threading.Thread):
 
     :param response: request response back from Sphero.
     """
-        self.send(self.pack_cmd(REQ['CMD_GET_PWR_STATE'], []), response)
+        return self.send(self.pack_cmd(REQ['CMD_GET_PWR_STATE'], []), response)
 
     def set_power_notify(self, enable, response):
         """
@@ -377,7 +1106,7 @@ class Sphero(threading.Thread):
     :param enable: 00h to disable and 01h to enable power notifications.
     :param response: request response back from Sphero.
     """
-        self.send(self.pack_cmd(REQ['CMD_SET_PWR_NOTIFY'], [enable]), response)
+        return self.send(self.pack_cmd(REQ['CMD_SET_PWR_NOTIFY'], [enable]), response)
 
     def go_to_sleep(self, time, macro, response):
         """
@@ -391,7 +1120,7 @@ class Sphero(threading.Thread):
     :param macro: macro number to run when re-awakened.
     :param response: request response back from Sphero.
     """
-        self.send(self.pack_cmd(REQ['CMD_SLEEP'], [(time >> 8), (time & 0xff), macro]), response)
+        return self.send(self.pack_cmd(REQ['CMD_SLEEP'], [(time >> 8), (time & 0xff), macro]), response)
 
     def run_l1_diags(self, response):
         """
@@ -403,7 +1132,7 @@ class Sphero(threading.Thread):
 
     :param response: request response back from Sphero.
     """
-        self.send(self.pack_cmd(REQ['CMD_RUN_L1_DIAGS'], []), response)
+        return self.send(self.pack_cmd(REQ['CMD_RUN_L1_DIAGS'], []), response)
 
     def run_l2_diags(self, response):
         """
@@ -414,7 +1143,7 @@ class Sphero(threading.Thread):
 
     :param response: request response back from Sphero.
     """
-        self.send(self.pack_cmd(REQ['CMD_RUN_L2_DIAGS'], []), response)
+        return self.send(self.pack_cmd(REQ['CMD_RUN_L2_DIAGS'], []), response)
 
     def clear_counters(self, response):
         """
@@ -423,7 +1152,7 @@ class Sphero(threading.Thread):
 
     :param response: request response back from Sphero.
     """
-        self.send(self.pack_cmd(REQ['CMD_CLEAR_COUNTERS'], []), response)
+        return self.send(self.pack_cmd(REQ['CMD_CLEAR_COUNTERS'], []), response)
 
     def assign_counter_value(self, counter, response):
         """
@@ -435,7 +1164,7 @@ class Sphero(threading.Thread):
     :param counter: value to set the counter to.
     :param response: request response back from Sphero.
     """
-        self.send(self.pack_cmd(REQ['CMD_ASSIGN_COUNTER'],
+        return self.send(self.pack_cmd(REQ['CMD_ASSIGN_COUNTER'],
                                 [((counter >> 24) & 0xff), ((counter >> 16) & 0xff), ((counter >> 8) & 0xff),
                                  (counter & 0xff)]), response)
 
@@ -468,7 +1197,7 @@ class Sphero(threading.Thread):
     :param time: client Tx time.
     :param response: request response back from Sphero.
     """
-        self.send(self.pack_cmd(REQ['CMD_POLL_TIME'],
+        return self.send(self.pack_cmd(REQ['CMD_POLL_TIMES'],
                                 [((time >> 24) & 0xff), ((time >> 16) & 0xff), ((time >> 8) & 0xff), (time & 0xff)]),
                   response)
 
@@ -483,7 +1212,7 @@ class Sphero(threading.Thread):
     shortest angular distance to heading command)
     :param response: request response back from Sphero.
     """
-        self.send(self.pack_cmd(REQ['CMD_SET_HEADING'], [(heading >> 8), (heading & 0xff)]), response)
+        return self.send(self.pack_cmd(REQ['CMD_SET_HEADING'], [(heading >> 8), (heading & 0xff)]), response)
 
     def set_stablization(self, enable, response):
         """
@@ -495,7 +1224,7 @@ class Sphero(threading.Thread):
     :param enable: 00h for off and 01h for on (on by default).
     :param response: request response back from Sphero.
     """
-        self.send(self.pack_cmd(REQ['CMD_SET_STABILIZ'], [enable]), response)
+        return self.send(self.pack_cmd(REQ['CMD_SET_STABILIZ'], [enable]), response)
 
     def set_rotation_rate(self, rate, response):
         """
@@ -510,7 +1239,7 @@ class Sphero(threading.Thread):
     will move in other funcation calls).
     :param response: request response back from Sphero.
     """
-        self.send(self.pack_cmd(REQ['CMD_SET_ROTATION_RATE'], [self.clamp(rate, 0, 255)]), response)
+        return self.send(self.pack_cmd(REQ['CMD_SET_ROTATION_RATE'], [self.clamp(rate, 0, 255)]), response)
 
     def set_app_config_blk(self, app_data, response):
         """
@@ -521,7 +1250,7 @@ class Sphero(threading.Thread):
     :param app_data: block set aside for application.
     :param response: request response back from Sphero.
     """
-        self.send(self.pack_cmd(REQ['CMD_SET_APP_CONFIG_BLK'],
+        return self.send(self.pack_cmd(REQ['CMD_SET_APP_CONFIG_BLK'],
                                 [((app_data >> 24) & 0xff), ((app_data >> 16) & 0xff), ((app_data >> 8) & 0xff),
                                  (app_data & 0xff)]), response)
 
@@ -531,7 +1260,7 @@ class Sphero(threading.Thread):
     that is set aside for exclusive use by applications.
     :param response: request response back from Sphero.
     """
-        self.send(self.pack_cmd(REQ['CMD_GET_APP_CONFIG_BLK'], []), response)
+        return self.send(self.pack_cmd(REQ['CMD_GET_APP_CONFIG_BLK'], []), response)
 
     def set_data_strm(self, sample_div, sample_frames, sample_mask1, pcnt, sample_mask2, response):
         """
@@ -553,7 +1282,15 @@ class Sphero(threading.Thread):
     :param sample_mask1: bitwise selector of data sources to stream.
     :param pcnt: packet count (set to 0 for unlimited streaming).
     :param response: request response back from Sphero.
+    :raises ValueError: the packets of sample_frames frames of the\
+    mask would be longer than MAX_DLEN.
     """
+        # every field is a 16-bit word, plus the checksum
+        data_length = 2 * len(mask_fields(STRM_MASK1, sample_mask1) + mask_fields(STRM_MASK2, sample_mask2)) * \
+            sample_frames + 1
+        if data_length > MAX_DLEN:
+            raise ValueError("%d frames of this mask need a DLEN of %d, at most %d fit" % (
+                sample_frames, data_length, MAX_DLEN))
         data = self.pack_cmd(REQ['CMD_SET_DATA_STRM'], \
                              [(sample_div >> 8), (sample_div & 0xff), (sample_frames >> 8), (sample_frames & 0xff),
                               ((sample_mask1 >> 24) & 0xff), \
@@ -563,8 +1300,11 @@ class Sphero(threading.Thread):
         self.create_mask_list(sample_mask1, sample_mask2)
         self.stream_mask1 = sample_mask1
         self.stream_mask2 = sample_mask2
+        self.stream_frames = sample_frames
+        # the framer must not take the longer packets as corrupted
+        self.framer.max_length = max(self.framer.max_length, data_length)
         # print data
-        self.send(data, response)
+        return self.send(data, response)
 
     def set_filtered_data_strm(self, sample_div, sample_frames, pcnt, response):
         """
@@ -583,7 +1323,7 @@ class Sphero(threading.Thread):
                 mask1 = mask1 | value
         for value in STRM_MASK2.itervalues():
             mask2 = mask2 | value
-        self.set_data_strm(sample_div, sample_frames, mask1, pcnt, mask2, response)
+        return self.set_data_strm(sample_div, sample_frames, mask1, pcnt, mask2, response)
 
     def set_raw_data_strm(self, sample_div, sample_frames, pcnt, response):
         """
@@ -602,7 +1342,7 @@ class Sphero(threading.Thread):
                 mask1 = mask1 | value
         for value in STRM_MASK2.itervalues():
             mask2 = mask2 | value
-        self.set_data_strm(sample_div, sample_frames, mask1, pcnt, mask2, response)
+        return self.set_data_strm(sample_div, sample_frames, mask1, pcnt, mask2, response)
 
 
     def set_all_data_strm(self, sample_div, sample_frames, pcnt, response):
@@ -621,7 +1361,7 @@ class Sphero(threading.Thread):
             mask1 = mask1 | value
         for value in STRM_MASK2.itervalues():
             mask2 = mask2 | value
-        self.set_data_strm(sample_div, sample_frames, mask1, pcnt, mask2, response)
+        return self.set_data_strm(sample_div, sample_frames, mask1, pcnt, mask2, response)
 
     def config_collision_detect(self, method, Xt, Xspd, Yt, Yspd, ignore_time, response):
         """
@@ -643,7 +1383,7 @@ class Sphero(threading.Thread):
     :param ignore_time: An 8-bit post-collision dead time to prevent\
     retriggering; specified in 10ms increments.
     """
-        self.send(self.pack_cmd(REQ['CMD_CFG_COL_DET'], [method, Xt, Xspd, Yt, Yspd, ignore_time]), response)
+        return self.send(self.pack_cmd(REQ['CMD_CFG_COL_DET'], [method, Xt, Xspd, Yt, Yspd, ignore_time]), response)
 
     def set_rgb_led(self, red, green, blue, save, response):
         """
@@ -659,7 +1399,7 @@ class Sphero(threading.Thread):
     :param blue: blue color value.
     :param save: 01h for save (color is saved as "user LED color").
     """
-        self.send(self.pack_cmd(REQ['CMD_SET_RGB_LED'],
+        return self.send(self.pack_cmd(REQ['CMD_SET_RGB_LED'],
                                 [self.clamp(red, 0, 255), self.clamp(green, 0, 255), self.clamp(blue, 0, 255), save]),
                   response)
 
@@ -671,7 +1411,7 @@ class Sphero(threading.Thread):
     :param brightness: 0-255, off-on (the blue LED on hemisphere of the Sphero).
     :param response: request response back from Sphero.
     """
-        self.send(self.pack_cmd(REQ['CMD_SET_BACK_LED'], [self.clamp(brightness, 0, 255)]), response)
+        return self.send(self.pack_cmd(REQ['CMD_SET_BACK_LED'], [self.clamp(brightness, 0, 255)]), response)
 
     def get_rgb_led(self, response):
         """
@@ -680,7 +1420,7 @@ class Sphero(threading.Thread):
 
     :param response: request response back from Sphero.
     """
-        self.send(self.pack_cmd(REQ['CMD_GET_RGB_LED'], []), response)
+        return self.send(self.pack_cmd(REQ['CMD_GET_RGB_LED'], []), response)
 
     def roll(self, speed, heading, state, response):
         """
@@ -697,8 +1437,9 @@ class Sphero(threading.Thread):
     :param state: 00h for off (braking) and 01h for on (driving).
     :param response: request response back from Sphero.
     """
-        self.send(self.pack_cmd(REQ['CMD_ROLL'], [self.clamp(speed, 0, 255), (heading >> 8), (heading & 0xff), state]),
-                  response)
+        # braking skips the transmit queue and drops the queued motion
+        return self.send(self.pack_cmd(REQ['CMD_ROLL'], [self.clamp(speed, 0, 255), (heading >> 8), (heading & 0xff), state]),
+                         response, stop=not state)
 
     def boost(self, time, heading, response):
         """
@@ -712,7 +1453,7 @@ class Sphero(threading.Thread):
     :param heading: the heading to travel while boosting.
     :param response: request response back from Sphero.
     """
-        self.send(self.pack_cmd(REQ['CMD_BOOST'], [time, (heading >> 8), (heading & 0xff)]), response)
+        return self.send(self.pack_cmd(REQ['CMD_BOOST'], [time, (heading >> 8), (heading & 0xff)]), response)
 
     def set_raw_motor_values(self, l_mode, l_power, r_mode, r_power, response):
         """
@@ -727,10 +1468,95 @@ class Sphero(threading.Thread):
     brake, 0x04 - ignored.
     :param power: 0-255 scalar value (units?).
     """
-        self.send(self.pack_cmd(REQ['CMD_SET_RAW_MOTORS'], [l_mode, l_power, r_mode, r_power]), response)
+        return self.send(self.pack_cmd(REQ['CMD_SET_RAW_MOTORS'], [l_mode, l_power, r_mode, r_power]), response)
 
-    def send(self, data, response):
+    def run_macro(self, macro_id, response):
         """
+    This attempts to execute the specified macro. Macro IDs are split
+    into groups: 0-31 are System Macros, 32-253 are User Macros, 254
+    is the streaming macro and 255 is the temporary macro.
+
+    :param macro_id: ID of the macro to run.
+    :param response: request response back from Sphero.
+    """
+        return self.send(self.pack_cmd(REQ['CMD_RUN_MACRO'], [macro_id]), response)
+
+    def save_temp_macro(self, code, response):
+        """
+    This stores the attached macro definition into the temporary RAM
+    buffer for later execution. Any existing macro ID 255 is
+    overwritten, a running temporary macro is aborted first.
+
+    :param code: compiled macro, see sphero_macro.Macro.compile.
+    :param response: request response back from Sphero.
+    """
+        return self.send(self.pack_cmd(REQ['CMD_SAVE_TEMP_MACRO'], bytearray(code)), response)
+
+    def save_macro(self, macro_id, code, response):
+        """
+    This stores the attached macro definition into the persistent
+    store for later execution.
+
+    :param macro_id: user macro ID 32-253.
+    :param code: compiled macro.
+    :param response: request response back from Sphero.
+    """
+        return self.send(self.pack_cmd(REQ['CMD_SAVE_MACRO'], bytearray([macro_id]) + bytearray(code)), response)
+
+    def delete_macro(self, macro_id, response):
+        """
+    :param macro_id: user macro ID to delete.
+    :param response: request response back from Sphero.
+    """
+        return self.send(self.pack_cmd(REQ['CMD_DEL_MACRO'], [macro_id]), response)
+
+    def init_macro_executive(self, response):
+        """
+    This terminates any running macro and reinitializes the macro
+    system. The table of any persistent user macros is cleared.
+
+    :param response: request response back from Sphero.
+    """
+        return self.send(self.pack_cmd(REQ['CMD_INIT_MACRO_EXECUTIVE'], []), response)
+
+    def abort_macro(self, response):
+        """
+    This command aborts any executing macro and returns both its ID
+    code and the command number currently in process. Like a stop it
+    drops the queued motion packets, so a macro still waiting to be
+    uploaded or run doesn't start after the abort.
+
+    :param response: request response back from Sphero.
+    """
+        return self.send(self.pack_cmd(REQ['CMD_ABORT_MACRO'], []), response, stop=True)
+
+    def get_macro_status(self, response):
+        """
+    This command returns the ID code and command number of the
+    currently executing macro. If no macro is running, 0x00 is returned
+    for the ID code.
+
+    :param response: request response back from Sphero.
+    """
+        return self.send(self.pack_cmd(REQ['CMD_GET_MACRO_STATUS'], []), response)
+
+    def set_macro_status(self, parameter, value, response):
+        """
+    This command allows system globals that influence certain macro
+    commands to be selectively altered from outside of the macro
+    system itself.
+
+    :param parameter: 0x01 - SD1, 0x02 - SD2, 0x03 - SPD1, 0x04 - SPD2.
+    :param value: 16-bit value.
+    :param response: request response back from Sphero.
+    """
+        return self.send(self.pack_cmd(REQ['CMD_SET_MACRO_STATUS'], [parameter, (value >> 8), (value & 0xff)]),
+                         response)
+
+    def send(self, data, response, urgent=False, stop=False):
+        """
+    Sends a packet built by pack_cmd.
+
     Packets are sent from Client -> Sphero in the following byte format::
 
       -------------------------------------------------------
@@ -751,24 +1577,69 @@ class Sphero(threading.Thread):
     * CHK - Checksum - The modulo 256 sum of all the bytes from the\
       DID through the end of the data payload, bit inverted (1's\
       complement).
+
+    Packets without response of the COALESCE commands are replaced by
+    newer ones while they wait in the transmit queue, urgent packets
+    are sent first. A stop is urgent and drops the queued MOTION
+    packets.
+
+    :return: SpheroResponse if a response was requested, else None.
     """
-        # compute the checksum
-        # modulo 256 sum of data bit inverted
-        checksum = ~ sum(data) % 256
+        key = (data[2], data[3])
+        pending = None
         # if expecting response back from the sphero
         if response:
-            output = REQ['WITH_RESPONSE'] + data + [checksum]
-        else:
-            output = REQ['WITHOUT_RESPONSE'] + data + [checksum]
-        # pack the msg
-        msg = ''.join(struct.pack('B', x) for x in output)
-        # send the msg
-        with self._communication_lock:
-            self.bt.send(msg)
+            data[1] = REQ['WITH_RESPONSE'][1]
+            # register before sending, the reader may see the answer first
+            pending = SpheroResponse(self, REQ_NAME.get(key), data[4])
+            with self._pending_lock:
+                self._pending[data[4]] = pending
+        msg = bytes(data)
+        if key in RESTORE:
+            # replayed without response after a reconnect
+            self._restore[key] = bytes(data[:1] + bytearray(REQ['WITHOUT_RESPONSE'][1:]) + data[2:])
+        # hand the msg to the writer thread, never blocks on the link
+        self.tx_scheduler.put(msg, pending, None if response or key not in COALESCE else key, urgent,
+                              key in MOTION, stop)
+        return pending
+
+    def _write_loop(self):
+        """
+    Writer thread: sends the packets of the transmit scheduler until
+    it is closed by disconnect.
+    """
+        while True:
+            item = self.tx_scheduler.get()
+            if item is None:
+                break
+            msg, pending = item
+            if pending is not None:
+                pending.sent = time.time()
+            try:
+                # a partial send would leave a truncated packet on the link
+                sent = 0
+                while sent < len(msg):
+                    sent += self.bt.send(msg[sent:])
+            except IOError:
+                if self.shutdown:
+                    break
+                # the link dropped - wait for the reader to bring it back
+                self._link_up.wait()
 
     def run(self):
-        # this is larger than any single packet
-        self.recv(1024)
+        while True:
+            # this is larger than any single packet
+            self.recv(1024)
+            if self.shutdown or not self.is_connected:
+                break
+            # the link dropped under us
+            self.is_connected = False
+            self._link_up.clear()
+            self.fail_pending("link lost")
+            address = self.bt.target_address
+            self.bt.close()
+            if self.reconnector is None or not self.reconnector.reconnect(self, address):
+                break
 
     def recv(self, num_bytes):
         '''
@@ -816,45 +1687,85 @@ class Sphero(threading.Thread):
     '''
 
         while self.is_connected and not self.shutdown:
-            with self._communication_lock:
-                self.raw_data_buf += self.bt.recv(num_bytes)
-            data = self.raw_data_buf
-            while len(data) > 5:
-                if data[:2] == RECV['SYNC']:
-                    # print "got response packet"
-                    # response packet
-                    data_length = ord(data[4])
-                    if data_length + 5 <= len(data):
-                        data_packet = data[:(5 + data_length)]
-                        data = data[(5 + data_length):]
-                    else:
-                        break
-                        # print "Response packet", self.data2hexstr(data_packet)
-
-                elif data[:2] == RECV['ASYNC']:
-                    data_length = (ord(data[3]) << 8) + ord(data[4])
-                    if data_length + 5 <= len(data):
-                        data_packet = data[:(5 + data_length)]
-                        data = data[(5 + data_length):]
-                    else:
-                        # the remainder of the packet isn't long enough
-                        break
-                    if data_packet[2] == IDCODE['DATA_STRM'] and self._async_callback_dict.has_key(IDCODE['DATA_STRM']):
-                        self._async_callback_dict[IDCODE['DATA_STRM']](self.parse_data_strm(data_packet, data_length))
-                    elif data_packet[2] == IDCODE['COLLISION'] and self._async_callback_dict.has_key(
-                            IDCODE['COLLISION']):
-                        self._async_callback_dict[IDCODE['COLLISION']](
-                            self.parse_collision_detect(data_packet, data_length))
-                    elif data_packet[2] == IDCODE['PWR_NOTIFY'] and self._async_callback_dict.has_key(
-                            IDCODE['PWR_NOTIFY']):
-                        self._async_callback_dict[IDCODE['PWR_NOTIFY']](self.parse_pwr_notify(data_packet, data_length))
-                        # else:
-
-                        # print("packet: ", self.data2hexstr(data_packet))
-                        # print("got a packet that isn't streaming")
-                else:
-                    raise RuntimeError("Bad SOF : " + self.data2hexstr(data))
-            self.raw_data_buf = data
+            # only this thread reads from the socket, so the blocking
+            # read doesn't hold up the writer
+            try:
+                if not self.framer.fill(self.bt, num_bytes):
+                    break
+            except IOError:
+                # closed by disconnect or the link dropped, see run
+                break
+            self.dispatch()
+
+    def dispatch(self):
+        """
+    Handles the complete packets in the framer: resolves responses and
+    calls the async callbacks.
+    """
+        for sop2, data_packet in self.framer.packets():
+            if sop2 == 0xff:
+                # response packet
+                # print "Response packet", self.data2hexstr(data_packet)
+                self.handle_response(data_packet)
+                continue
+            data_length = (ord(data_packet[3]) << 8) + ord(data_packet[4])
+            if data_packet[2] == IDCODE['DATA_STRM'] and self._async_callback_dict.has_key(IDCODE['DATA_STRM']) \
+                    and self.strm_struct is not None:
+                sample = self.parse_data_strm(data_packet, data_length)
+                if sample is not None:
+                    self.call_async(IDCODE['DATA_STRM'], sample)
+            elif data_packet[2] == IDCODE['COLLISION'] and self._async_callback_dict.has_key(
+                    IDCODE['COLLISION']):
+                self.call_async(IDCODE['COLLISION'], self.parse_collision_detect(data_packet, data_length))
+            elif data_packet[2] == IDCODE['PWR_NOTIFY'] and self._async_callback_dict.has_key(
+                    IDCODE['PWR_NOTIFY']):
+                self.call_async(IDCODE['PWR_NOTIFY'], self.parse_pwr_notify(data_packet, data_length))
+                # else:
+
+                # print("packet: ", self.data2hexstr(data_packet))
+                # print("got a packet that isn't streaming")
+
+    def call_async(self, callback_type, data):
+        """Calls the async callback of callback_type, see call_callback"""
+        self.call_callback(self._async_callback_dict[callback_type], data)
+
+    def call_callback(self, callback, data):
+        """
+    Calls a user callback on the reader thread. An exception in the
+    callback is counted, the first one logged - it must not end the
+    reader thread.
+    """
+        try:
+            callback(data)
+        except Exception:
+            self.callback_errors += 1
+            if self.callback_errors == 1:
+                self.logger.exception("callback %r failed, further errors are only counted", callback)
+
+    def handle_response(self, data):
+        """
+    Resolves the pending command with the SEQ of the response packet.
+    Responses nobody waits for (e.g. timed out) are dropped.
+    """
+        seq = ord(data[3])
+        with self._pending_lock:
+            pending = self._pending.pop(seq, None)
+        if pending is None:
+            return
+        pending.rtt = time.time() - pending.sent
+        self.rtt_sum += pending.rtt
+        self.rtt_count += 1
+        counts = self.rtt_histogram.setdefault(pending.command, [0] * len(RTT_BUCKETS))
+        counts[bisect.bisect_left(RTT_BUCKETS, pending.rtt)] += 1
+
+        code = ord(data[2])
+        if code != MRSP['ORBOTIX_RSP_CODE_OK']:
+            pending.set_error(SpheroError(pending.command, MRSP_NAME.get(code, "unknown response code"), code))
+            return
+        payload = data[5:-1].tobytes()
+        pending.set_result(payload)
+        if self._sync_callback_dict.has_key(pending.command):
+            self.call_callback(self._sync_callback_dict[pending.command], payload)
 
     def parse_pwr_notify(self, data, data_length):
         '''
@@ -871,7 +1782,7 @@ class Sphero(threading.Thread):
       * 03h = Battery Low, 
       * 04h = Battery Critical
     '''
-        return struct.unpack_from('B', ''.join(data[5:]))[0]
+        return struct.unpack_from('B', data, 5)[0]
 
     def parse_collision_detect(self, data, data_length):
         '''
@@ -901,22 +1812,529 @@ class Sphero(threading.Thread):
         output = {}
 
         output['X'], output['Y'], output['Z'], output['Axis'], output['xMagnitude'], output['yMagnitude'], output[
-            'Speed'], output['Timestamp'] = struct.unpack_from('>hhhbhhbI', ''.join(data[5:]))
+            'Speed'], output['Timestamp'] = struct.unpack_from('>hhhbhhbI', data, 5)
         return output
 
     def parse_data_strm(self, data, data_length):
-        output = {}
-        for i in range((data_length - 1) / 2):
-            unpack = struct.unpack_from('>h', ''.join(data[5 + 2 * i:]))
-            output[self.mask_list[i]] = unpack[0]
-        # print self.mask_list
-        # print output
-        return output
+        '''
+    The data payload of the async message holds sample_frames frames,
+    each frame is one signed 16-bit word for every field of the stream
+    mask, in the order of mask_list. All frames are decoded at once
+    with numpy, a single frame the same way as several.
+
+    Packets that don't match the current mask, e.g. still in flight\
+    after a mask change, are counted in strm_mismatched and skipped.
+
+    :return: int16 array of shape (frames, len(mask_list)), one row\
+    even for one frame per packet, None for a mismatched packet.
+    '''
+        if data_length - 1 != self.strm_struct.size * self.stream_frames:
+            self.strm_mismatched += 1
+            return None
+        fields = len(self.mask_list)
+        frames = (data_length - 1) // (2 * fields)
+        # numpy can't take the memoryview in python 2, one copy per packet
+        payload = data[5:5 + 2 * fields * frames].tobytes()
+        return np.frombuffer(payload, self.strm_dtype).reshape(frames, fields)
 
 
     def disconnect(self):
         self.is_connected = False
+        self.shutdown = True
+        self._link_up.set()
+        # let the writer flush what is already queued (e.g. a stop)
+        self.tx_scheduler.close()
+        if self._writer is not None and self._writer.is_alive():
+            self._writer.join(1.0)
         self.bt.close()
+        self.fail_pending("disconnected")
         return self.is_connected
 
+    def fail_pending(self, message):
+        """Resolves all commands waiting for a response with an error"""
+        with self._pending_lock:
+            pending, self._pending = self._pending.values(), dict()
+        for response in pending:
+            response.set_error(SpheroError(response.command, message))
+
+
+
+def async_packet(idcode, data):
+    """Async packet Sphero -> Client, for the development tests"""
+    body = bytearray([ord(idcode), (len(data) + 1) >> 8, (len(data) + 1) & 0xff]) + bytearray(data)
+    return bytes(bytearray([0xff, 0xfe]) + body + bytearray([~sum(body) & 0xff]))
+
+
+def socketpair_interface():
+    """
+    SocketInterface on one end of a socketpair, stand-in for BTInterface
+    in the development tests.
+
+    :return: (interface, socket of the other end).
+    """
+    local, remote = socket.socketpair()
+    bt = SocketInterface()
+    bt.sock = local
+    bt.target_address = 'socketpair://'
+    return bt, remote
+
+
+def response_packet(code, seq, data=()):
+    """Response packet Sphero -> Client, for the development tests"""
+    body = bytearray([code, seq, len(data) + 1]) + bytearray(data)
+    return bytes(bytearray([0xff, 0xff]) + body + bytearray([~sum(body) & 0xff]))
+
+
+def synthetic_packets(size=1 << 20, seed=1):
+    """
+    Recorded-like receive stream for the development tests: responses,
+    DATA_STRM packets of 20 fields, collisions and power notifications
+    in random order.
+
+    :return: list of packets, at least size bytes together.
+    """
+    rand = random.Random(seed)
+    packets = []
+    length = 0
+    while length < size:
+        kind = rand.random()
+        if kind < 0.7:
+            packet = async_packet(IDCODE['DATA_STRM'], bytearray(rand.getrandbits(8) for i in range(40)))
+        elif kind < 0.9:
+            packet = response_packet(0, rand.getrandbits(8), bytearray(rand.getrandbits(8)
+                                                                       for i in range(rand.randint(0, 8))))
+        elif kind < 0.97:
+            packet = async_packet(IDCODE['COLLISION'], bytearray(rand.getrandbits(8) for i in range(16)))
+        else:
+            packet = async_packet(IDCODE['PWR_NOTIFY'], [0x02])
+        packets.append(packet)
+        length += len(packet)
+    return packets
+
+
+def synthetic_capture(size=1 << 20, seed=1):
+    """:return: (synthetic_packets as one str, number of packets)."""
+    packets = synthetic_packets(size, seed)
+    return ''.join(packets), len(packets)
+
+
+class CaptureReader(object):
+    """Interface reading a capture in chunks, for the development tests"""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def recv(self, num_bytes):
+        chunk = self.data[self.pos:self.pos + num_bytes]
+        self.pos += len(chunk)
+        return chunk
+
+    def recv_into(self, buf, num_bytes):
+        chunk = self.recv(num_bytes)
+        buf[:len(chunk)] = chunk
+        return len(chunk)
+
+
+def former_packets(bt, num_bytes):
+    """
+    The former receive loop of Sphero.recv without the callbacks: a list
+    of characters, re-sliced for every packet.
+
+    :return: number of packets.
+    """
+    count = 0
+    raw_data_buf = []
+    while True:
+        chunk = bt.recv(num_bytes)
+        if not chunk:
+            return count
+        raw_data_buf += chunk
+        data = raw_data_buf
+        while len(data) > 5:
+            if data[:2] == RECV['SYNC']:
+                data_length = ord(data[4])
+            elif data[:2] == RECV['ASYNC']:
+                data_length = (ord(data[3]) << 8) + ord(data[4])
+            else:
+                raise RuntimeError("Bad SOF")
+            if data_length + 5 > len(data):
+                break
+            data_packet = data[:(5 + data_length)]
+            data = data[(5 + data_length):]
+            count += 1
+        raw_data_buf = data
+
+
+def bench_framer(size=1 << 20, chunks=(256, 1024, 4096, 16384)):
+    """
+    Only for Development Tests - receive throughput of PacketFramer
+    against the former list based loop over a synthetic capture of size
+    bytes, read with each of the chunk sizes. The former loop re-slices
+    the whole pending list for every packet, so it slows down with
+    larger reads (a backlog after a stall).
+    """
+    capture, count = synthetic_capture(size)
+    print "capture: %d bytes, %d packets" % (len(capture), count)
+    print "%6s %16s %16s %8s" % ("chunk", "former MB/s", "framer MB/s", "speedup")
+    for num_bytes in chunks:
+        start = time.time()
+        former = former_packets(CaptureReader(capture), num_bytes)
+        former_time = time.time() - start
+
+        framer = PacketFramer()
+        bt = CaptureReader(capture)
+        found = 0
+        start = time.time()
+        while framer.fill(bt, num_bytes):
+            for sop2, packet in framer.packets():
+                found += 1
+        framer_time = time.time() - start
+        if former != count or found != count:
+            print "packet count mismatch: former %d, framer %d, expected %d" % (former, found, count)
+        print "%6d %16.2f %16.2f %7.1fx" % (num_bytes, len(capture) / former_time / 1e6,
+                                            len(capture) / framer_time / 1e6, former_time / framer_time)
+
+
+class ThrottledLink(object):
+    """
+    Fake link of the development tests: send takes as long as the bytes
+    need at rate bytes per second and records (time, packet).
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.sent = []
+        self.throttle = True
+
+    def send(self, data):
+        if self.throttle:
+            time.sleep(len(data) / float(self.rate))
+        self.sent.append((time.time(), data))
+        return len(data)
+
+    def close(self):
+        self.throttle = False
+
+
+def check_scheduler_order():
+    """
+    Only for Development Tests - coalescing must not reorder commands:
+    a newer roll goes out after a set_heading queued before it, and a
+    coalesced packet goes out before an in order one queued after it.
+    """
+    sequences = (
+        ([('roll', 50, 10, 1, False), ('set_heading', 0, False), ('roll', 60, 20, 1, False)],
+         [('CMD_SET_HEADING', [0, 0]), ('CMD_ROLL', [60, 0, 20, 1])]),
+        ([('set_back_led', 255, False), ('set_stablization', 0, False)],
+         [('CMD_SET_BACK_LED', [255]), ('CMD_SET_STABILIZ', [0])]),
+        ([('roll', 50, 10, 1, False), ('set_stablization', 1, False), ('set_heading', 90, False),
+          ('roll', 70, 30, 1, False), ('set_back_led', 10, False), ('roll', 80, 40, 1, False)],
+         [('CMD_ROLL', [50, 0, 10, 1]), ('CMD_SET_STABILIZ', [1]), ('CMD_SET_HEADING', [0, 90]),
+          ('CMD_SET_BACK_LED', [10]), ('CMD_ROLL', [80, 0, 40, 1])]),
+    )
+    for calls, expected in sequences:
+        sphero = Sphero()
+        for call in calls:
+            getattr(sphero, call[0])(*call[1:])
+        sent = []
+        while True:
+            item, wait = sphero.tx_scheduler.poll()
+            if item is None:
+                break
+            packet = bytearray(item[0])
+            sent.append((REQ_NAME[(packet[2], packet[3])], list(packet[6:-1])))
+        print "%-60s %s" % (' '.join(call[0] for call in calls), ' '.join(name[4:] for name, data in sent))
+        assert sent == expected, "sent %s, expected %s" % (sent, expected)
+
+
+def bench_scheduler(duration=2.0, command_rate=1000, link_rate=5000):
+    """
+    Only for Development Tests - checks the order with
+    check_scheduler_order, then runs a tactics loop rolling
+    command_rate times per second over a link of link_rate bytes per
+    second (a roll is 11 bytes), in order (fifo) and coalesced with and
+    without max_rate. Staleness is the age of a roll value when it
+    arrives.
+    """
+    check_scheduler_order()
+    print "%-16s %10s %10s %8s %16s %16s" % ("scheduler", "issued/s", "sent/s", "merged", "staleness mean",
+                                             "staleness max")
+    for name, coalesce, max_rate in (('fifo', False, None), ('coalesce', True, None),
+                                     ('coalesce 20/s', True, 20)):
+        sphero = Sphero()
+        sphero.bt = ThrottledLink(link_rate)
+        sphero.is_connected = True
+        sphero.tx_scheduler.max_rate = max_rate
+        sphero.start_io()
+        issued = dict()
+        count = 0
+        start = time.time()
+        next_command = start
+        while time.time() - start < duration:
+            speed, heading = count % 255 + 1, (count // 255) % 360
+            issued[(speed, heading)] = time.time()
+            if coalesce:
+                sphero.roll(speed, heading, 1, None)
+            else:
+                sphero.tx_scheduler.put(bytes(sphero.pack_cmd(REQ['CMD_ROLL'], [speed, heading >> 8,
+                                                                                heading & 0xff, 1])))
+            count += 1
+            next_command += 1.0 / command_rate
+            time.sleep(max(0.0, next_command - time.time()))
+        elapsed = time.time() - start
+        sent = [(stamp, bytearray(packet)) for stamp, packet in list(sphero.bt.sent)]
+        # send the backlog without delay, it is not measured
+        sphero.bt.close()
+        sphero.disconnect()
+        staleness = [stamp - issued[(packet[6], (packet[7] << 8) + packet[8])] for stamp, packet in sent]
+        print "%-16s %10.0f %10.0f %8d %14.1fms %14.1fms" % (
+            name, count / elapsed, len(sent) / elapsed, sphero.tx_scheduler.stats()['merged'],
+            1000 * sum(staleness) / max(1, len(staleness)), 1000 * max(staleness or [0]))
+
+
+def former_packet(req, seq, cmd, response):
+    """The former pack_cmd and send: a list of ints packed byte by byte"""
+    data = req + [seq] + [len(cmd) + 1] + cmd
+    checksum = ~ sum(data) % 256
+    output = (REQ['WITH_RESPONSE'] if response else REQ['WITHOUT_RESPONSE']) + data + [checksum]
+    return ''.join(struct.pack('B', x) for x in output)
+
+
+def encoder_packet(sphero, req, cmd, response):
+    """The packet send puts on the link, without queueing it"""
+    data = sphero.pack_cmd(req, cmd)
+    if response:
+        data[1] = REQ['WITH_RESPONSE'][1]
+    return bytes(data)
+
+
+def bench_encoder(count=20000):
+    """
+    Only for Development Tests - compares the encoder with the former one
+    byte for byte for every command of REQ, with and without response
+    and several payload lengths, then times both for rolls and for all
+    commands in turn.
+    """
+    rand = random.Random(1)
+    commands = sorted(name for name in REQ if name.startswith('CMD_'))
+    sphero = Sphero()
+    checked = mismatches = 0
+    for name in commands:
+        for length in (0, 1, 4, 16, 60):
+            cmd = [rand.getrandbits(8) for i in range(length)]
+            for response in (False, True):
+                packet = encoder_packet(sphero, REQ[name], cmd, response)
+                checked += 1
+                if packet != former_packet(REQ[name], sphero.seq, cmd, response):
+                    mismatches += 1
+                    print "mismatch: %s %s" % (name, sphero.data2hexstr(packet))
+    print "%d packets of %d commands checked, %d mismatches" % (checked, len(commands), mismatches)
+
+    roll = [128, 1, 14, 1]
+    loads = (('roll', [(REQ['CMD_ROLL'], roll)] * count),
+             ('all commands', [(REQ[commands[i % len(commands)]], roll) for i in range(count)]))
+    for load, packets in loads:
+        start = time.time()
+        for seq, (req, cmd) in enumerate(packets):
+            former_packet(req, seq & 0xff, cmd, False)
+        former = (time.time() - start) / count
+        start = time.time()
+        for req, cmd in packets:
+            encoder_packet(sphero, req, cmd, False)
+        encoder = (time.time() - start) / count
+        print "%-13s former: %6.2f us  encoder: %6.2f us  speedup: %.1fx" % (load, former * 1e6, encoder * 1e6,
+                                                                           former / encoder)
+
+
+def fuzz_framer(size=1 << 20, rates=(1e-5, 1e-4, 1e-3), num_bytes=1024, link_rate=11520):
+    """
+    Only for Development Tests - replays the synthetic capture with
+    random bytes corrupted at each rate (per byte) through PacketFramer.
+
+    Counts the intact packets delivered and lost, and corrupted packets
+    that passed the checksum. Recovery is the intact stream lost after a
+    corrupted packet until the next delivered one, in bytes and in ms at
+    link_rate bytes per second (115200 baud). The former loop stopped
+    at the first bad start byte.
+    """
+    rand = random.Random(2)
+    packets = synthetic_packets(size)
+    offsets = []
+    length = 0
+    for packet in packets:
+        offsets.append(length)
+        length += len(packet)
+    capture = bytearray(''.join(packets))
+    print "%8s %8s %10s %8s %8s %10s %14s %12s %10s" % (
+        "rate", "corrupt", "delivered", "lost", "false", "crc/frame", "recovery mean", "recovery max", "packets/s")
+    for rate in rates:
+        data = bytearray(capture)
+        positions = sorted(rand.sample(xrange(len(data)), max(1, int(len(data) * rate))))
+        for pos in positions:
+            data[pos] ^= rand.randint(1, 255)
+        corrupted = sorted(set(bisect.bisect_right(offsets, pos) - 1 for pos in positions))
+        broken = set(corrupted)
+
+        framer = PacketFramer()
+        bt = CaptureReader(bytes(data))
+        delivered = dict()
+        false = 0
+        start = time.time()
+        while framer.fill(bt, num_bytes):
+            for sop2, packet in framer.packets():
+                offset = framer.bytes_received - (framer.end - framer.start) - len(packet)
+                index = bisect.bisect_right(offsets, offset) - 1
+                if offsets[index] == offset and index not in broken and packet.tobytes() == packets[index]:
+                    delivered[index] = True
+                else:
+                    false += 1
+        elapsed = time.time() - start
+
+        # intact packets lost after each corrupted one until the stream was picked up again
+        recovery = []
+        for index in corrupted:
+            lost = 0
+            for following in xrange(index + 1, len(packets)):
+                if following in delivered or following in broken:
+                    break
+                lost += len(packets[following])
+            recovery.append(lost)
+        intact = len(packets) - len(broken)
+        stats = framer.stats()
+        print "%8.0e %8d %10d %8d %8d %4d/%-5d %8.2f B %4.2fms %6d B %9.0f" % (
+            rate, len(broken), len(delivered), intact - len(delivered), false, stats['crc_errors'],
+            stats['framing_errors'], float(sum(recovery)) / len(recovery),
+            1000.0 * sum(recovery) / len(recovery) / link_rate, max(recovery), len(delivered) / elapsed)
+
+    data = bytearray(capture)
+    data[offsets[len(offsets) / 2]] ^= 0x55
+    try:
+        count = former_packets(CaptureReader(bytes(data)), num_bytes)
+    except RuntimeError:
+        count = None
+    print "former loop with one bad start byte in the middle: %s" % (
+        "%d packets" % count if count is not None else "RuntimeError, the reader thread ends")
+
+
+def _stream_peer(sock, rate, packet_size, arrivals, arrived, stop):
+    """
+    Fake Sphero of bench_latency: sends a DATA_STRM packet rate times per
+    second and stamps every complete command packet of packet_size bytes.
+    """
+    packet = async_packet(IDCODE['DATA_STRM'], bytearray(16))
+    received = 0
+    next_packet = time.time()
+    while not stop.is_set():
+        timeout = max(0.0, next_packet - time.time()) if rate else 0.05
+        readable = select.select([sock], [], [], timeout)[0]
+        if readable:
+            data = sock.recv(4096)
+            if not data:
+                break
+            now = time.time()
+            received += len(data)
+            while received >= packet_size:
+                received -= packet_size
+                arrivals.append(now)
+                arrived.set()
+        if rate and time.time() >= next_packet:
+            sock.sendall(packet)
+            next_packet += 1.0 / rate
+
+
+def bench_latency(rates=(0, 10, 40, 100), commands=30):
+    """
+    Only for Development Tests - command send latency against the cadence
+    of the data stream, over a socketpair.
+
+    A fake Sphero streams DATA_STRM packets at each rate and stamps the
+    arrival of the roll commands. The driver's reader and writer threads
+    own one direction of the socket each. The former design held one
+    lock over the blocking read, so a send waited for the next inbound
+    packet. It is shown for comparison, except at rate 0, where it waits
+    forever.
+    """
+    roll = bytes(Sphero().pack_cmd(REQ['CMD_ROLL'], [0, 0, 0, 1]))
+    packet_size = len(roll)
+    print "%-8s %6s %14s %14s %14s" % ("design", "Hz", "call mean ms", "arrival mean", "arrival max")
+    for design in ('threads', 'former'):
+        for rate in rates:
+            if design == 'former' and not rate:
+                continue
+            bt, remote = socketpair_interface()
+            arrivals = []
+            arrived = threading.Event()
+            stop = threading.Event()
+            peer = threading.Thread(target=_stream_peer, args=(remote, rate, packet_size, arrivals, arrived, stop))
+            peer.daemon = True
+            peer.start()
+            if design == 'threads':
+                sphero = Sphero()
+                sphero.bt = bt
+                sphero.is_connected = True
+                sphero._link_up.set()
+                sphero.daemon = True
+                sphero.start_io()
+                sphero.start()
+                send = lambda speed: sphero.roll(speed, 0, 1, None)
+            else:
+                lock = threading.Lock()
+
+                def read():
+                    while not stop.is_set():
+                        with lock:
+                            if not bt.recv(1024):
+                                break
+                reader = threading.Thread(target=read)
+                reader.daemon = True
+                reader.start()
+
+                def send(speed):
+                    with lock:
+                        bt.send(roll)
+            calls = []
+            latencies = []
+            for i in range(commands):
+                arrived.clear()
+                count = len(arrivals)
+                start = time.time()
+                send(1 + i % 200)
+                calls.append(time.time() - start)
+                while len(arrivals) <= count and arrived.wait(2.0):
+                    arrived.clear()
+                if len(arrivals) > count:
+                    latencies.append(arrivals[count] - start)
+                # decorrelate the commands from the stream phase
+                time.sleep(random.uniform(0, 0.01))
+            stop.set()
+            peer.join(1.0)
+            if design == 'threads':
+                sphero.disconnect()
+            else:
+                bt.close()
+            remote.close()
+            print "%-8s %6d %14.3f %14.3f %14.3f" % (design, rate, 1000 * sum(calls) / len(calls),
+                                                      1000 * sum(latencies) / max(1, len(latencies)),
+                                                      1000 * max(latencies or [0]))
+
+
+def main():
+    """
+    Only for Development Tests: sphero_driver.py <test>
 
+    * latency - command send latency against the stream cadence.
+    * framer - receive throughput over a synthetic 1 MB capture.
+    * scheduler - commands per second and staleness of coalesced rolls.
+    * encoder - packet encoding against the former encoder.
+    * fuzz - framer recovery and throughput on a corrupted capture.
+    """
+    tests = dict(latency=bench_latency, framer=bench_framer, scheduler=bench_scheduler, encoder=bench_encoder,
+                 fuzz=fuzz_framer)
+    if len(sys.argv) < 2 or sys.argv[1] not in tests:
+        print "Usage: sphero_driver.py " + "|".join(sorted(tests))
+        return
+    tests[sys.argv[1]]()
+
+if __name__ == '__main__':
+    main()
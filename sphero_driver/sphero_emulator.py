@@ -0,0 +1,449 @@
+"""
+Software Sphero speaking the Sphero wire protocol over a socket.
+
+SpheroEmulator parses the REQ commands from the client, acknowledges
+the ones sent with response with the right SEQ, integrates simple
+roll / heading kinematics at the 400Hz control rate, runs uploaded
+macros and emits the DATA_STRM, COLLISION and PWR_NOTIFY async
+packets. Use it with Sphero.connect('emu://') or run a TCP server
+with serve() and connect to 'tcp://127.0.0.1:port'.
+
+Units of the emulated state: position in cm, heading in degrees
+(0 straight ahead = +y, 90 right = +x), speed 0-255.
+"""
+import sys
+import math
+import time
+import errno
+import select
+import socket
+import struct
+import threading
+
+from sphero_driver import REQ, REQ_NAME, MRSP, IDCODE, STRM_MASK1, STRM_MASK2, mask_fields
+from sphero_macro import TEMP_MACRO, decode
+
+
+# Control system rate of Sphero
+CONTROL_RATE = 400
+# Speed in cm/s at speed 255
+MAX_SPEED = 200.0
+# Acceleration and braking in cm/s^2
+ACCELERATION = 400.0
+# Turn rate in degrees/s per rotation rate unit
+ROTATION_UNIT = 0.784
+
+# Data payload of the responses to get commands
+RESPONSE_DATA = dict(
+    CMD_VERSION=[0x02, 0x00, 0x01, 0x00, 0x33, 0x10, 0x01, 0x00],
+    CMD_GET_PWR_STATE=[0x01, 0x02, 0x02, 0xd0, 0x00, 0x10, 0x00, 0x00],
+    CMD_GET_AUTO_RECONNECT=[0x00, 0x00],
+    CMD_GET_DEVICE_MODE=[0x00])
+
+
+def pack_async(idcode, data):
+    """Async packet Sphero -> Client"""
+    body = bytearray([ord(idcode), (len(data) + 1) >> 8, (len(data) + 1) & 0xff]) + bytearray(data)
+    return bytes(bytearray(REQ['WITHOUT_RESPONSE']) + body + bytearray([~sum(body) & 0xff]))
+
+
+def pack_response(code, seq, data=()):
+    """Response packet Sphero -> Client"""
+    body = bytearray([code, seq, len(data) + 1]) + bytearray(data)
+    return bytes(bytearray(REQ['WITH_RESPONSE']) + body + bytearray([~sum(body) & 0xff]))
+
+
+class SpheroEmulator(threading.Thread):
+    """
+    Emulated Sphero on one end of a connected socket.
+    """
+
+    def __init__(self, sock, name='Sphero-EMU', arena_radius=None):
+        """
+        :param sock: connected socket to the client.
+        :param name: Bluetooth name.
+        :param arena_radius: radius in cm of the ring, the ball collides
+        with its edge. None for no edge.
+        """
+        threading.Thread.__init__(self, name='Thread-' + name)
+        self.daemon = True
+        self.sock = sock
+        self.bt_name = name
+        self.arena_radius = arena_radius
+        self.shutdown = False
+        self._lock = threading.Lock()
+        self._rx = bytearray()
+        self._tx = bytearray()
+
+        # motion state
+        self.x = 0.0
+        self.y = 0.0
+        self.heading = 0.0
+        self.velocity = 0.0
+        self.target_speed = 0
+        self.target_heading = 0
+        self.stabilization = True
+        self.rotation_rate = 0xc8
+        self.rgb = (0, 0, 0)
+        self.back_led = 0
+        self.ticks = 0
+        self._last = None
+
+        # async configuration
+        self.strm_div = 0
+        self.strm_frames = 1
+        self.strm_fields = []
+        self.strm_pcnt = 0
+        self.strm_buf = []
+        self.col_method = 0
+        self.col_threshold = (0, 0)
+        self.col_ignore_ticks = 0
+        self.col_blocked_until = 0
+        self.pwr_notify = False
+        self.pwr_next = 0
+
+        # macro executive: id -> decoded commands, the running one
+        self.macros = dict()
+        self.macro = None
+        self.macro_id = 0
+        self.macro_pc = 0
+        self.macro_wait = 0
+        self.macro_loops = []
+
+        # counters
+        self.commands = 0
+        self.bad_packets = 0
+
+    def stop(self):
+        self.shutdown = True
+
+    def disconnect(self):
+        """Drops the link like a ball going out of range"""
+        self.shutdown = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def inject_collision(self, x=0, y=1000):
+        """Emits a collision event as if the ball was hit"""
+        with self._lock:
+            self._emit_collision(x, y)
+
+    def run(self):
+        self.sock.setblocking(False)
+        self._last = time.time()
+        try:
+            while not self.shutdown:
+                wait = 1.0 / CONTROL_RATE
+                writers = [self.sock] if self._tx else []
+                readable, writable, _ = select.select([self.sock], writers, [], wait)
+                if readable:
+                    data = self.sock.recv(1024)
+                    if not data:
+                        break
+                    self._rx += data
+                    self._parse()
+                with self._lock:
+                    self._step(time.time())
+                if self._tx:
+                    try:
+                        n = self.sock.send(bytes(self._tx))
+                        del self._tx[:n]
+                    except socket.error as error:
+                        if error.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                            raise
+        except (socket.error, select.error):
+            pass
+        finally:
+            self.sock.close()
+
+    def _parse(self):
+        """Handles the complete client packets in the receive buffer"""
+        buf = self._rx
+        while len(buf) >= 6:
+            if buf[0] != 0xff or buf[1] not in (0xff, 0xfe):
+                self.bad_packets += 1
+                del buf[0]
+                continue
+            size = 6 + buf[5]
+            if len(buf) < size:
+                break
+            packet = buf[:size]
+            del buf[:size]
+            if ~sum(packet[2:-1]) & 0xff != packet[-1]:
+                self.bad_packets += 1
+                if packet[1] == 0xff:
+                    self._tx += pack_response(MRSP['ORBOTIX_RSP_CODE_ECHKSUM'], packet[4])
+                continue
+            with self._lock:
+                code, data = self._command(REQ_NAME.get((packet[2], packet[3])), packet[6:-1])
+            self.commands += 1
+            if packet[1] == 0xff:
+                self._tx += pack_response(code, packet[4], data)
+
+    def _command(self, name, data):
+        """
+        Executes a command.
+
+        :return: MRSP code and data of the response.
+        """
+        if name is None:
+            return MRSP['ORBOTIX_RSP_CODE_EBAD_CMD'], ()
+        if name == 'CMD_ROLL':
+            self.target_speed = data[0]
+            self.target_heading = ((data[1] << 8) + data[2]) % 360
+            if not data[3]:
+                self.target_speed = 0
+        elif name == 'CMD_SET_HEADING':
+            # the current direction becomes the new heading 0
+            self.heading = self.target_heading = 0
+        elif name == 'CMD_SET_STABILIZ':
+            self.stabilization = bool(data[0])
+        elif name == 'CMD_SET_ROTATION_RATE':
+            self.rotation_rate = data[0]
+        elif name == 'CMD_SET_RGB_LED':
+            self.rgb = tuple(data[:3])
+        elif name == 'CMD_GET_RGB_LED':
+            return MRSP['ORBOTIX_RSP_CODE_OK'], self.rgb
+        elif name == 'CMD_SET_BACK_LED':
+            self.back_led = data[0]
+        elif name == 'CMD_SET_DATA_STRM':
+            self._set_data_strm(data)
+        elif name == 'CMD_CFG_COL_DET':
+            self.col_method = data[0]
+            self.col_threshold = (data[1], data[3])
+            self.col_ignore_ticks = data[5] * CONTROL_RATE / 100
+        elif name == 'CMD_SET_PWR_NOTIFY':
+            self.pwr_notify = bool(data[0])
+            self.pwr_next = self.ticks
+        elif name in ('CMD_SAVE_TEMP_MACRO', 'CMD_SAVE_MACRO'):
+            macro_id = TEMP_MACRO if name == 'CMD_SAVE_TEMP_MACRO' else data[0]
+            try:
+                self.macros[macro_id] = decode(data if name == 'CMD_SAVE_TEMP_MACRO' else data[1:])
+            except ValueError:
+                return MRSP['ORBOTIX_RSP_CODE_EBAD_MSG'], ()
+            if self.macro_id == macro_id:
+                self.macro = None
+        elif name == 'CMD_RUN_MACRO':
+            if data[0] not in self.macros:
+                return MRSP['ORBOTIX_RSP_CODE_EPARAM'], ()
+            self.macro, self.macro_id = self.macros[data[0]], data[0]
+            self.macro_pc = self.macro_wait = 0
+            self.macro_loops = []
+        elif name in ('CMD_ABORT_MACRO', 'CMD_GET_MACRO_STATUS'):
+            status = (self.macro_id if self.macro is not None else 0, self.macro_pc >> 8, self.macro_pc & 0xff)
+            if name == 'CMD_ABORT_MACRO':
+                self.macro = None
+                self.target_speed = 0
+            return MRSP['ORBOTIX_RSP_CODE_OK'], status
+        elif name == 'CMD_DEL_MACRO':
+            self.macros.pop(data[0], None)
+        elif name == 'CMD_INIT_MACRO_EXECUTIVE':
+            self.macro = None
+            self.macros = dict((macro_id, code) for macro_id, code in self.macros.iteritems()
+                               if macro_id == TEMP_MACRO)
+        elif name == 'CMD_GET_BT_NAME':
+            return MRSP['ORBOTIX_RSP_CODE_OK'], bytearray(self.bt_name[:16].ljust(16, '\0'))
+        return MRSP['ORBOTIX_RSP_CODE_OK'], RESPONSE_DATA.get(name, ())
+
+    def _set_data_strm(self, data):
+        div, frames, mask1, pcnt, mask2 = struct.unpack('>HHIBI', bytes(data[:13].ljust(13, '\0')))
+        self.strm_div = div
+        self.strm_frames = max(frames, 1)
+        self.strm_fields = mask_fields(STRM_MASK1, mask1) + mask_fields(STRM_MASK2, mask2)
+        self.strm_pcnt = pcnt
+        self.strm_buf = []
+
+    def _step(self, now):
+        """Integrates the motion up to now in control rate ticks"""
+        dt = 1.0 / CONTROL_RATE
+        ticks = int((now - self._last) * CONTROL_RATE)
+        self._last += ticks * dt
+        for i in range(ticks):
+            self.ticks += 1
+            if self.macro is not None:
+                self._macro_tick()
+            # turn towards the target heading on the shortest way
+            if self.stabilization:
+                turn = (self.target_heading - self.heading + 180) % 360 - 180
+                rate = 720.0 if self.rotation_rate == 255 else self.rotation_rate * ROTATION_UNIT
+                self.heading = (self.heading + max(-rate * dt, min(rate * dt, turn))) % 360
+            # speed up or brake towards the target speed
+            target = self.target_speed * MAX_SPEED / 255
+            step = ACCELERATION * dt
+            self.velocity += max(-step, min(step, target - self.velocity))
+            self.x += self.velocity * math.sin(math.radians(self.heading)) * dt
+            self.y += self.velocity * math.cos(math.radians(self.heading)) * dt
+            self._check_arena()
+
+            if self.strm_div and self.strm_fields and self.ticks % self.strm_div == 0:
+                self.strm_buf.append(self._frame())
+                if len(self.strm_buf) >= self.strm_frames:
+                    payload = ''.join(struct.pack('>%dh' % len(frame), *frame) for frame in self.strm_buf)
+                    self._tx += pack_async(IDCODE['DATA_STRM'], bytearray(payload))
+                    self.strm_buf = []
+                    if self.strm_pcnt:
+                        self.strm_pcnt -= 1
+                        if not self.strm_pcnt:
+                            self.strm_div = 0
+            if self.pwr_notify and self.ticks >= self.pwr_next:
+                # battery OK every 10 seconds
+                self._tx += pack_async(IDCODE['PWR_NOTIFY'], [0x02])
+                self.pwr_next = self.ticks + 10 * CONTROL_RATE
+
+    def _macro_tick(self):
+        """Runs the macro commands that are due in this tick"""
+        if self.macro_wait:
+            self.macro_wait -= 1
+            return
+        while self.macro is not None and not self.macro_wait:
+            if self.macro_pc >= len(self.macro):
+                self.macro = None
+                break
+            name, args = self.macro[self.macro_pc]
+            self.macro_pc += 1
+            self.macro_wait = self._macro_command(name, args) * CONTROL_RATE / 1000
+
+    def _macro_command(self, name, args):
+        """
+        Executes a macro command.
+
+        :return: delay in ms before the next command.
+        """
+        if name == 'END':
+            self.macro = None
+        elif name in ('ROLL', 'ROLL2'):
+            self.target_speed = args[0]
+            self.target_heading = args[1] % 360
+            return args[2]
+        elif name == 'DELAY':
+            return args[0]
+        elif name == 'SET_HEADING':
+            self.heading = self.target_heading = 0
+        elif name == 'SET_STABILIZATION':
+            self.stabilization = bool(args[0])
+        elif name == 'SET_ROTATION_RATE':
+            self.rotation_rate = args[0]
+        elif name == 'SET_RGB_LED':
+            self.rgb = args[:3]
+        elif name == 'SET_BACK_LED':
+            self.back_led = args[0]
+        elif name == 'LOOP_START':
+            self.macro_loops.append([self.macro_pc, args[0]])
+        elif name == 'LOOP_END' and self.macro_loops:
+            self.macro_loops[-1][1] -= 1
+            if self.macro_loops[-1][1] > 0:
+                self.macro_pc = self.macro_loops[-1][0]
+            else:
+                self.macro_loops.pop()
+        return args[-1] if name in ('SET_HEADING', 'SET_STABILIZATION', 'SET_ROTATION_RATE', 'SET_RGB_LED',
+                                    'SET_BACK_LED') else 0
+
+    def _check_arena(self):
+        if self.arena_radius is None:
+            return
+        dist = math.hypot(self.x, self.y)
+        if dist > self.arena_radius:
+            # stop at the edge, the impact is against the direction of travel
+            self.x *= self.arena_radius / dist
+            self.y *= self.arena_radius / dist
+            impact = self.velocity
+            self.velocity = 0.0
+            self._emit_collision(0, int(impact * 10))
+
+    def _emit_collision(self, x, y):
+        if not self.col_method or self.ticks < self.col_blocked_until:
+            return
+        x_mag, y_mag = abs(x), abs(y)
+        axis = (1 if x_mag > self.col_threshold[0] else 0) | (2 if y_mag > self.col_threshold[1] else 0)
+        if not axis:
+            return
+        self.col_blocked_until = self.ticks + self.col_ignore_ticks
+        speed = int(self.velocity * 255 / MAX_SPEED)
+        timestamp = self.ticks * 1000 / CONTROL_RATE
+        payload = struct.pack('>hhhbhhbI', x, y, 0, axis, x_mag, y_mag, min(speed, 127), timestamp & 0xffffffff)
+        self._tx += pack_async(IDCODE['COLLISION'], bytearray(payload))
+
+    def _frame(self):
+        """One DATA_STRM frame of the configured fields"""
+        heading = math.radians(self.heading)
+        values = dict(
+            ODOM_X=self.x,
+            ODOM_Y=self.y,
+            VELOCITY_X=self.velocity * math.sin(heading) * 10,
+            VELOCITY_Y=self.velocity * math.cos(heading) * 10,
+            IMU_YAW_FILTERED=(self.heading + 180) % 360 - 180,
+            ACCEL_Z_RAW=4096,
+            ACCEL_Z_FILTERED=4096,
+            QUATERNION_Q0=10000)
+        return [max(-32768, min(32767, int(values.get(field, 0)))) for field in self.strm_fields]
+
+
+class EmulatorServer(threading.Thread):
+    """
+    TCP server starting a SpheroEmulator for every connection.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, **kwargs):
+        """
+        :param port: TCP port, 0 picks a free one (see address).
+        :param kwargs: passed to every SpheroEmulator.
+        """
+        threading.Thread.__init__(self, name='Thread-EmulatorServer')
+        self.daemon = True
+        self.kwargs = kwargs
+        self.emulators = []
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(8)
+        self.address = self.server.getsockname()
+        self.shutdown = False
+
+    def uri(self):
+        return 'tcp://%s:%d' % self.address
+
+    def run(self):
+        while not self.shutdown:
+            try:
+                sock, peer = self.server.accept()
+            except socket.error:
+                break
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            emulator = SpheroEmulator(sock, 'Sphero-EMU-%d' % len(self.emulators), **self.kwargs)
+            self.emulators.append(emulator)
+            emulator.start()
+
+    def stop(self):
+        self.shutdown = True
+        self.server.close()
+        for emulator in self.emulators:
+            emulator.stop()
+
+
+def serve(host='127.0.0.1', port=0, **kwargs):
+    """
+    Starts an EmulatorServer.
+
+    :return: the running server, connect to server.uri()
+    """
+    server = EmulatorServer(host, port, **kwargs)
+    server.start()
+    return server
+
+
+def main():
+    "Runs an emulator server: sphero_emulator.py [port]"
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 9000
+    server = serve('127.0.0.1', port, arena_radius=90)
+    sys.stdout.write("Sphero emulator on %s\n" % server.uri())
+    sys.stdout.flush()
+    try:
+        while server.is_alive():
+            server.join(1)
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == '__main__':
+    main()
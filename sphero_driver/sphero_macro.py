@@ -0,0 +1,170 @@
+"""
+Compiler for Sphero macros.
+
+A macro is a byte program run by the macro executive of Sphero: each
+command is one opcode byte followed by its big-endian arguments. Most
+commands end with a PCD byte, the post command delay in ms. Build a
+program with the Macro methods or the motion primitives below, then
+upload it with Sphero.save_temp_macro and start it with
+Sphero.run_macro(TEMP_MACRO). During the manoeuvre only these two
+packets go over the link instead of one roll per loop.
+
+compile() and decode() need no robot, the encoding can be checked
+offline.
+"""
+import struct
+
+
+# name: (opcode, struct of the arguments), from the Orbotix macro documentation
+MACRO_CMD = dict(
+    END=(0x00, ''),
+    SET_SD1=(0x01, '>H'),
+    SET_SD2=(0x02, '>H'),
+    SET_STABILIZATION=(0x03, '>BB'),  # flag, PCD
+    SET_HEADING=(0x04, '>HB'),  # heading, PCD
+    ROLL=(0x05, '>BHB'),  # speed, heading, PCD
+    SET_RGB_LED=(0x07, '>BBBB'),  # red, green, blue, PCD
+    SET_BACK_LED=(0x08, '>BB'),  # brightness, PCD
+    DELAY=(0x0b, '>H'),  # ms
+    SET_ROTATION_RATE=(0x13, '>BB'),  # rate, PCD
+    ROLL2=(0x1d, '>BHH'),  # speed, heading, delay in ms
+    LOOP_START=(0x1e, '>B'),  # count
+    LOOP_END=(0x1f, ''))
+
+# opcode -> (name, struct)
+MACRO_NAME = dict((code, (name, struct.Struct(fmt))) for name, (code, fmt) in MACRO_CMD.iteritems())
+
+# id of the temporary macro in RAM
+TEMP_MACRO = 0xff
+# largest temporary macro
+MAX_TEMP_MACRO = 254
+
+
+class Macro(object):
+    """
+    Macro program builder, all command methods return the macro so
+    they can be chained.
+    """
+
+    def __init__(self):
+        self.code = bytearray()
+        # heading of the last roll, kept by stop
+        self.heading = 0
+
+    def add(self, name, *args):
+        """Appends the command name with its arguments"""
+        code, fmt = MACRO_CMD[name]
+        self.code.append(code)
+        self.code += struct.pack(fmt, *args) if fmt else ''
+        return self
+
+    def roll(self, speed, heading, delay=0):
+        """
+    :param speed: 0-255.
+    :param heading: 0-359.
+    :param delay: ms until the next command, up to 65535.
+    """
+        heading = int(heading) % 360
+        self.heading = heading
+        if delay > 0xff:
+            return self.add('ROLL2', speed, heading, delay)
+        return self.add('ROLL', speed, heading, delay)
+
+    def stop(self, delay=0):
+        """Brakes, the heading of the last roll stays"""
+        return self.roll(0, self.heading, delay)
+
+    def delay(self, ms):
+        return self.add('DELAY', ms)
+
+    def set_heading(self, heading, delay=0):
+        return self.add('SET_HEADING', heading, delay)
+
+    def set_stabilization(self, enable, delay=0):
+        return self.add('SET_STABILIZATION', int(bool(enable)), delay)
+
+    def set_rotation_rate(self, rate, delay=0):
+        return self.add('SET_ROTATION_RATE', rate, delay)
+
+    def set_rgb_led(self, red, green, blue, delay=0):
+        return self.add('SET_RGB_LED', red, green, blue, delay)
+
+    def set_back_led(self, brightness, delay=0):
+        return self.add('SET_BACK_LED', brightness, delay)
+
+    def loop_start(self, count):
+        return self.add('LOOP_START', count)
+
+    def loop_end(self):
+        return self.add('LOOP_END')
+
+    def compile(self):
+        """
+    :return: the program as str, terminated with END.
+    :raises ValueError: if it doesn't fit into the temporary macro.
+    """
+        code = self.code + bytearray([MACRO_CMD['END'][0]])
+        if len(code) > MAX_TEMP_MACRO:
+            raise ValueError("macro has %d bytes, at most %d fit" % (len(code), MAX_TEMP_MACRO))
+        return bytes(code)
+
+
+def decode(code):
+    """
+    Disassembles a compiled macro.
+
+    :return: list of (name, args) up to and including END.
+    :raises ValueError: for an unknown opcode or a truncated command.
+    """
+    code = bytearray(code)
+    commands = []
+    pos = 0
+    while pos < len(code):
+        if code[pos] not in MACRO_NAME:
+            raise ValueError("unknown macro opcode 0x%02x at %d" % (code[pos], pos))
+        name, args = MACRO_NAME[code[pos]]
+        if pos + 1 + args.size > len(code):
+            raise ValueError("truncated %s at %d" % (name, pos))
+        commands.append((name, args.unpack_from(bytes(code), pos + 1)))
+        pos += 1 + args.size
+        if name == 'END':
+            break
+    return commands
+
+
+def circle(speed, period, steps=12, loops=1, heading=0):
+    """
+    Drives circles by turning the heading in steps.
+
+    :param speed: 0-255.
+    :param period: ms for one circle.
+    :param steps: headings per circle, more is rounder but longer.
+    :param loops: number of circles, up to 255.
+    :param heading: heading of the first step.
+    """
+    macro = Macro().loop_start(loops)
+    for i in range(steps):
+        macro.roll(speed, heading + i * 360 / steps, period / steps)
+    return macro.loop_end().stop()
+
+
+def strafe(speed, heading, duration, loops=1):
+    """
+    Moves to the right and back to the left of heading.
+
+    :param duration: ms of each side.
+    """
+    macro = Macro().loop_start(loops)
+    macro.roll(speed, heading + 90, duration)
+    macro.roll(speed, heading + 270, duration)
+    return macro.loop_end().stop()
+
+
+def boost_and_brake(speed, heading, boost, brake=300):
+    """
+    Full speed burst then hard braking.
+
+    :param boost: ms at speed.
+    :param brake: ms to come to rest.
+    """
+    return Macro().roll(speed, heading, boost).stop(brake)
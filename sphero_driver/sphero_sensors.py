@@ -0,0 +1,135 @@
+"""
+History of the DATA_STRM samples of one Sphero.
+
+SensorHistory keeps the last capacity samples in a preallocated numpy
+ring buffer, one row per mask field (column oriented, so the window of
+one field is a contiguous slice). It is fed by the driver's reader
+thread through the DATA_STRM async callback and read from any other
+thread without a lock: the latest sample is published through two
+alternating buffers, windows are copied and checked against the write
+counter like a seqlock.
+"""
+import time
+
+import numpy as np
+
+from sphero_driver import IDCODE
+
+
+class SensorHistory(object):
+    """
+    Fixed size sample history, memory doesn't grow with the run time.
+    Only one thread may call feed.
+    """
+
+    def __init__(self, fields, capacity=1024, rate=None):
+        """
+    :param fields: mask field names in stream order, e.g. Sphero.mask_list.
+    :param capacity: number of samples kept.
+    :param rate: samples per second, used to time the frames of a\
+    multi-frame packet. None stamps all frames with the receive time.
+    """
+        self.fields = list(fields)
+        self.index = dict((name, i) for i, name in enumerate(self.fields))
+        self.capacity = capacity
+        self.rate = rate
+        self.data = np.zeros((len(self.fields), capacity), np.int16)
+        self.times = np.zeros(capacity)
+        # samples written since the start, the ring position is count % capacity
+        self.count = 0
+        self._writing = 0
+        self.mismatched = 0
+        # double buffered latest sample, readers get whole (count, time, values)
+        self._buffers = (np.zeros(len(self.fields), np.int16), np.zeros(len(self.fields), np.int16))
+        self._back = 0
+        self._latest = (0, 0.0, self._buffers[1])
+
+    @classmethod
+    def attach(cls, sphero, capacity=1024, rate=None):
+        """
+    Creates a history for the current stream mask of sphero and
+    registers it as its DATA_STRM callback. Attach again after
+    changing the mask.
+    """
+        history = cls(sphero.mask_list, capacity, rate)
+        sphero.add_async_callback(IDCODE['DATA_STRM'], history.feed)
+        return history
+
+    def feed(self, sample, now=None):
+        """
+    DATA_STRM callback.
+
+    :param sample: int16 array of shape (frames, fields) as returned\
+    by Sphero.parse_data_strm.
+    """
+        if now is None:
+            now = time.time()
+        frames = sample
+        if frames.shape[1] != len(self.fields):
+            # stream mask changed under us
+            self.mismatched += 1
+            return
+        num = min(len(frames), self.capacity)
+        frames = frames[-num:]
+        if self.rate and num > 1:
+            stamps = now - np.arange(num - 1, -1, -1) / float(self.rate)
+        else:
+            stamps = np.repeat(now, num)
+
+        # announce the samples before writing them, see window
+        self._writing = self.count + num
+        pos = self.count % self.capacity
+        first = min(num, self.capacity - pos)
+        self.data[:, pos:pos + first] = frames[:first].T
+        self.times[pos:pos + first] = stamps[:first]
+        if first < num:
+            self.data[:, :num - first] = frames[first:].T
+            self.times[:num - first] = stamps[first:]
+        self.count += num
+
+        back = self._buffers[self._back]
+        back[:] = frames[-1]
+        # a single reference store, readers see the old or the new sample
+        self._latest = (self.count, now, back)
+        self._back ^= 1
+
+    def latest(self):
+        """
+    O(1) access to the newest sample without copying.
+
+    :return: (count, time, values) - values is indexed like fields and\
+    stays valid until the next but one sample, copy it to keep it.
+    """
+        return self._latest
+
+    def value(self, name):
+        """:return: newest value of the field name"""
+        return self._latest[2][self.index[name]]
+
+    def window(self, num, names=None):
+        """
+    Copy of the newest samples, oldest first.
+
+    :param num: number of samples, at most capacity.
+    :param names: fields to copy, default all.
+    :return: (times, data) - data has one row per field of names.
+    """
+        while True:
+            count = self.count
+            num = min(num, count, self.capacity)
+            order = np.arange(count - num, count) % self.capacity
+            times = self.times[order]
+            if names is None:
+                data = self.data[:, order]
+            else:
+                data = self.data[np.ix_([self.index[name] for name in names], order)]
+            # retry if the writer started to overwrite part of the window while copying
+            if self._writing - count <= self.capacity - num:
+                return times, data
+
+    def snapshot(self):
+        """:return: dict field name -> samples of the whole history, oldest first, and 'time'"""
+        times, data = self.window(self.capacity)
+        snapshot = dict(zip(self.fields, data))
+        snapshot['time'] = times
+        return snapshot
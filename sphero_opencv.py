@@ -1,17 +1,214 @@
 # coding=utf-8
 import logging
 import json
-import os
+import sys
+import select
+import socket
 import threading
 import time
 import numpy as np
 import cv2
+import sphero_tracker
+from sphero_config import loadConfig
 
 
 # OpenCV config parameter
 CV_CAP_PROP_FRAME_WIDTH = 3
 CV_CAP_PROP_FRAME_HEIGHT = 4
-CV_CAP_PROP_FRAME_RATE = 6
+CV_CAP_PROP_FRAME_RATE = 5
+
+# HSV range of a colour profile
+COLOUR_KEYS = ('cLowH', 'cHighH', 'cLowS', 'cHighS', 'cLowV', 'cHighV')
+# Detection preprocessing, see Opencv.setVision
+VISION_DEFAULT = {'pyramid': 0, 'filter': 'legacy', 'kernel': 15}
+
+
+class FrameGrabber(threading.Thread):
+    """
+    Reads the camera in its own thread and holds only the newest frame,
+    so the processing never works on a stale frame from the driver buffer
+    """
+    def __init__(self, source=0, width=800, height=600, realtime=None):
+        """
+        :param source: camera index or video file
+        :param width: frame width of a camera
+        :param height: frame height of a camera
+        :param realtime: play a video file at its frame rate like a camera, default True for files
+        """
+        threading.Thread.__init__(self, name='Thread-FrameGrabber')
+        self.daemon = True
+        self.logger = logging.getLogger('sphero.grabber')
+        self.threadExit = False
+        if isinstance(source, basestring) and source.isdigit():
+            source = int(source)
+        self.isFile = not isinstance(source, int)
+        self.realtime = self.isFile if realtime is None else realtime
+
+        self.cap = cv2.VideoCapture(source)
+        if not self.isFile:
+            self.cap.set(CV_CAP_PROP_FRAME_WIDTH, width)
+            self.cap.set(CV_CAP_PROP_FRAME_HEIGHT, height)
+        self.fps = self.cap.get(CV_CAP_PROP_FRAME_RATE) or 30.0
+
+        # Slot of size 1: (frame, capture time, frame number)
+        self.slot = None
+        self.slotCond = threading.Condition()
+        self.lastRead = 0
+        self.isEnd = False
+
+        # Metrics
+        self.captured = 0
+        self.consumed = 0
+        self.dropped = 0
+        self.ageSum = 0.0
+        self.ageMax = 0.0
+        self.startTime = None
+
+    def run(self):
+        self.startTime = now()
+        nextTime = self.startTime
+        while not self.threadExit:
+            ret, frame = self.cap.read()
+            if not ret:
+                break
+            stamp = now()
+            with self.slotCond:
+                if self.slot is not None and self.slot[2] > self.lastRead:
+                    # Nobody took the old frame - drop it
+                    self.dropped += 1
+                self.captured += 1
+                self.slot = (frame, stamp, self.captured)
+                self.slotCond.notify_all()
+            if self.realtime:
+                nextTime += 1.0 / self.fps
+                time.sleep(max(0.0, nextTime - now()))
+
+        self.cap.release()
+        with self.slotCond:
+            self.isEnd = True
+            self.slotCond.notify_all()
+        self.logger.info("Grabber stopped %s", self.getStats())
+
+    def read(self, timeout=1.0):
+        """
+        Wait for a frame newer than the last one read
+        :param timeout: seconds to wait
+        :return: frame and capture time (seconds of now()) or None, None on timeout or end of the source
+        """
+        with self.slotCond:
+            end = now() + timeout
+            while (self.slot is None or self.slot[2] <= self.lastRead) and not self.isEnd:
+                remaining = end - now()
+                if remaining <= 0:
+                    return None, None
+                self.slotCond.wait(remaining)
+            if self.slot is None or self.slot[2] <= self.lastRead:
+                return None, None
+            frame, stamp, number = self.slot
+            self.lastRead = number
+        age = now() - stamp
+        self.consumed += 1
+        self.ageSum += age
+        self.ageMax = max(self.ageMax, age)
+        return frame, stamp
+
+    def stop(self):
+        self.threadExit = True
+
+    def getStats(self):
+        """
+        Grabber metrics
+        :return: dict with capture and processing fps, captured, consumed and dropped frames,
+        mean and max frame age at consumption in seconds
+        """
+        elapsed = now() - self.startTime if self.startTime else 0
+        return dict(captureFps=self.captured / elapsed if elapsed else 0.0,
+                    processFps=self.consumed / elapsed if elapsed else 0.0,
+                    captured=self.captured, consumed=self.consumed, dropped=self.dropped,
+                    ageMean=self.ageSum / self.consumed if self.consumed else None,
+                    ageMax=self.ageMax)
+
+
+class PreviewServer(threading.Thread):
+    """
+    Debug preview as MJPEG stream over HTTP, e.g. http://127.0.0.1:8080/
+    The tracker only publishes the frame reference, drawing and JPEG encoding
+    run in this thread at a limited rate and only while a client watches
+    """
+    def __init__(self, port=8080, fps=5, host='127.0.0.1'):
+        """
+        :param port: local TCP port
+        :param fps: maximal preview frame rate
+        :param host: interface to listen on
+        """
+        threading.Thread.__init__(self, name='Thread-Preview')
+        self.daemon = True
+        self.logger = logging.getLogger('sphero.preview')
+        self.threadExit = False
+        self.fps = fps
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(2)
+        self.clients = []
+        # (frame, detections) of the tracker, replaced as a whole
+        self.latest = None
+        self.sent = 0
+
+    def publish(self, frame, detections):
+        """
+        Offer a frame to the preview, called by the tracker - only stores the reference
+        """
+        self.latest = (frame, detections)
+
+    def run(self):
+        self.logger.info("Preview on port %d", self.server.getsockname()[1])
+        shown = None
+        nextTime = now()
+        while not self.threadExit:
+            readable = select.select([self.server], [], [], max(0.0, nextTime - now()))[0]
+            if readable:
+                client, address = self.server.accept()
+                client.settimeout(0.5)
+                try:
+                    client.recv(1024)
+                    client.sendall('HTTP/1.0 200 OK\r\nCache-Control: no-cache\r\n'
+                                   'Content-Type: multipart/x-mixed-replace; boundary=frame\r\n\r\n')
+                    self.clients.append(client)
+                except socket.error:
+                    client.close()
+                continue
+            nextTime = now() + 1.0 / self.fps
+
+            latest = self.latest
+            if not self.clients or latest is None or latest is shown:
+                continue
+            shown = latest
+            frame, detections = latest
+            frame = frame.copy()
+            for name, detection in detections.iteritems():
+                if detection is not None:
+                    cv2.circle(frame, (detection[0], detection[1]), int(detection[2]), (0, 0, 255), 2)
+                    cv2.putText(frame, name, (detection[0] + 5, detection[1] - 5), cv2.FONT_HERSHEY_SIMPLEX, 0.5,
+                                (255, 255, 255))
+            ret, jpeg = cv2.imencode('.jpg', frame)
+            part = '--frame\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n' % len(jpeg)
+            for client in list(self.clients):
+                try:
+                    client.sendall(part + jpeg.tostring() + '\r\n')
+                except socket.error:
+                    # Slow or gone - drop the client, not the tracker
+                    self.clients.remove(client)
+                    client.close()
+            self.sent += 1
+
+        for client in self.clients:
+            client.close()
+        self.server.close()
+
+    def stop(self):
+        self.threadExit = True
+
 
 class Opencv(threading.Thread):
     """
@@ -23,16 +220,36 @@ class Opencv(threading.Thread):
 
         self.threadExit = False
         self.args = args
-        self.kwargs = kwargs
+        self.kwargs = kwargs or {}
 
         self.logger = logging.getLogger('sphero.opencv')
         self.enemy = loadConfig('enemy')
         self.me = loadConfig('me')
+        # Colour profiles detected in every frame, the order of the mask channels
+        self.profiles = (('enemy', self.enemy), ('me', self.me))
+        # Detection preprocessing and its cached kernels
+        self.kernels = {}
+        self.setVision(loadConfig(self.kwargs.get('vision', 'vision')))
+        # Quantized BGR -> profile bits table, 6 bits: 64x64x64
+        self.lutBits = 6
+        self.lut = None
+        self.lutKey = None
+        self.profileBits = {}
+        # Headless: no windows and no drawing in the frame
+        self.isHeadless = self.kwargs.get('headless', False)
+        # Optional MJPEG preview on a local port
+        self.preview = None
+        if self.kwargs.get('preview'):
+            self.preview = PreviewServer(int(self.kwargs['preview']), self.kwargs.get('previewFps', 5))
+        # Tracking: profile name -> (x, y, radius, vx, vy, frame time) of the last detection
+        self.isTracking = self.kwargs.get('tracking', True)
+        self.tracks = {}
+        self.trackStats = dict(frames=0, roiSearches=0, fullSearches=0, lost=0, time=0.0)
         self.homo = loadConfig('homo')
         self.frame = None
-        self.cap = cv2.VideoCapture(0)
-        self.cap.set(CV_CAP_PROP_FRAME_WIDTH, 800)
-        self.cap.set(CV_CAP_PROP_FRAME_HEIGHT, 600)
+        self.frameTime = None
+        # Camera index or video file
+        self.grabber = FrameGrabber(self.kwargs.get('source', 0))
         # Homography Data
         self.isHomo = False
         self.isCalibrateDist = True
@@ -54,6 +271,12 @@ class Opencv(threading.Thread):
         # Speed Data
         self.speedMe = None
         self.speedEnemy = None
+        # Position and velocity filter in world coordinates
+        self.tracker = sphero_tracker.KalmanTracker(('enemy', 'me'))
+        # Seconds from a command to Sphero acting on it, fed by the tactics from the link measurements
+        self.linkLatency = 0.0
+        # Optional json file of the detected world positions per frame for sphero_tracker.evaluatePrediction
+        self.trackLog = [] if self.kwargs.get('recordTrack') else None
 
 
     def run(self):
@@ -63,54 +286,40 @@ class Opencv(threading.Thread):
         self.logger.info("Thread Opencv Started")
 
         # Call config in config parameter is set
-        if self.kwargs['config']:
+        if self.kwargs.get('config'):
             self.openCVconfig()
             return
 
-        frameDistance = 8
-        frameCounter = 0
+        self.grabber.start()
+        if self.preview is not None:
+            self.preview.start()
         while not self.threadExit:
 
-            # Capture frame-by-frame
-            ret, frame = self.cap.read()
+            # Newest frame of the grabber
+            frame, self.frameTime = self.grabber.read()
+            if frame is None:
+                if self.grabber.isEnd:
+                    break
+                continue
             self.frame = frame[132:571, 170:672]
 
-            # get direction and direction of own Sphero
-            posMe = self.getPosition(1)
-            posEnemy = self.getPosition(0)
-
-            # take first frame at start and furthermore every 8 frame
-            if frameCounter % frameDistance == 0:
-                time1 = time.time()
-                pointMe = posMe
-            elif frameCounter % frameDistance == frameDistance - 1:
-                time2 = time.time()
-                pointMe2 = posMe
-
-                #
-                if (pointMe is not None) and (pointMe2 is not None):
-                    direction = calcDirection(pointMe[0], pointMe[1], pointMe2[0], pointMe2[1])
-                    speed = calculateSpeed(self, pointMe[0], pointMe[1], pointMe2[0], pointMe2[1], time1, time2)
-                    self.speedMe = speed
-                    self.directionMe = direction
-
-            # get direction and direction of enemy Sphero
-            if frameCounter % frameDistance == 0:
-                timeEnemy1 = time.time()
-                pointEnemy = self.getPosition(0)
-            elif frameCounter % frameDistance == frameDistance - 1:
-                timeEnemy2 = time.time()
-                pointEnemy2 = self.getPosition(0)
-
-                if (pointEnemy is not None) and (pointEnemy2 is not None) \
-                        and (pointMe is not None) and (pointMe2 is not None):
-                    direction = calcDirection(pointEnemy[0], pointEnemy[1], pointEnemy2[0], pointEnemy2[1])
-                    speed = calculateSpeed(self, pointMe[0], pointMe[1], pointMe2[0], pointMe[1], timeEnemy1,
-                                           timeEnemy2)
-                    self.speedEnemy = speed
-                    self.directionEnemy = direction
-
-            frameCounter += 1
+            # Detect both Spheros in one pass
+            detections = self.detectAll()
+
+            # Kalman filter on every detection, with the capture time of the frame
+            measurements = {'me': self.coordsMe if detections['me'] else None,
+                            'enemy': self.coordsEnemy if detections['enemy'] else None}
+            self.tracker.update(self.frameTime, measurements)
+            self.updateMotion()
+            if self.trackLog is not None:
+                self.trackLog.append((self.frameTime, measurements))
+
+            if self.preview is not None:
+                self.preview.publish(self.frame, detections)
+
+            if self.isHeadless:
+                # No window - exit by threadExit only
+                continue
 
             # Display the resulting frame
             cv2.imshow('frame', self.frame)
@@ -119,8 +328,50 @@ class Opencv(threading.Thread):
                 break
 
         # When everything done, release the capture
-        self.cap.release()
-        cv2.destroyAllWindows()
+        self.grabber.stop()
+        if self.preview is not None:
+            self.preview.stop()
+        if not self.isHeadless:
+            cv2.destroyAllWindows()
+        if self.trackLog is not None:
+            saveTrack(self.kwargs['recordTrack'], self.trackLog)
+
+    def updateMotion(self):
+        """
+        Set speed (cm/s) and direction (degrees as cart2pol) of both Spheros from the tracker
+        """
+        for name in ('me', 'enemy'):
+            state = self.tracker.getState(name)
+            speed = direction = None
+            if state is not None:
+                speed, direction = state['speed'], state['heading']
+            if name == 'me':
+                self.speedMe, self.directionMe = speed, direction
+            else:
+                self.speedEnemy, self.directionEnemy = speed, direction
+
+    def predict(self, robot, t=None):
+        """
+        Position of a Sphero extrapolated by the tracker, to compensate the delay of camera, detection and link
+        :param robot: 'me' or 'enemy'
+        :param t: time in seconds of now(), default the arrival of a command given now (now() + linkLatency)
+        :return: (x, y) in cm or None if not tracked
+        """
+        if t is None:
+            t = now() + self.linkLatency
+        state = self.tracker.predict(robot, t)
+        return state['position'] if state is not None else None
+
+    def getLatency(self):
+        """
+        Latency metrics
+        :return: dict with the mean frame age at processing, mean detection time per frame,
+        link latency and the current prediction horizon (now + link latency - last frame time) in seconds
+        """
+        frameTime = self.frameTime
+        return dict(frameAge=self.grabber.getStats()['ageMean'], detection=self.getTrackStats()['frameTime'],
+                    link=self.linkLatency,
+                    horizon=now() + self.linkLatency - frameTime if frameTime is not None else None)
 
     def nothing(x, y=None):
         pass
@@ -147,50 +398,230 @@ class Opencv(threading.Thread):
         :param enemy: Set enemy == 0 for Enemy Sphero and 1 for own Sphero
         :return: list of x-Position, y-Position and radius
         """
+        return self.detectAll()['me' if enemy else 'enemy']
 
-        if enemy == 0:
-            config = self.enemy
-        else:
-            config = self.me
-
-        points = None
-
-        lowerColor = np.array([config['cLowH'], config['cLowS'], config['cLowV']])
-        upperColor = np.array([config['cHighH'], config['cHighS'], config['cHighV']])
-
-        imgHSV = cv2.cvtColor(self.frame, cv2.COLOR_BGR2HSV)
-        mask = cv2.inRange(imgHSV, lowerColor, upperColor)
-
-        mask[mask == 0] = 0
-        # Bitwise-AND mask and original image
-        res = cv2.bitwise_and(self.frame, self.frame, mask=mask)
-        kernel = np.ones((15, 15), np.uint8)
-
-        # erosion = cv2.erode(mask,kernel,iterations = 1)
-        mask = cv2.GaussianBlur(mask, (15, 15), 0)
-
-        mask = cv2.erode(mask, kernel)
-        mask = cv2.dilate(mask, kernel)
-
-        coord = None
-        points = np.dstack(np.where(mask > 0)).astype(np.float32)
-
-        if len(points[0]) > 0:
-            center, radius = cv2.minEnclosingCircle(points)
-
-            #if center is not None and radius is not None:
-            # draw this circle
-            cv2.circle(self.frame, (int(center[1]), int(center[0])), 2, (0, 0, 255), 3)
-            coord = ([int(center[1]), int(center[0]), radius])
-
-            if enemy == 0:
-                self.coordsEnemy = self.getPerspectivePosition(coord)
+    def detectAll(self):
+        """
+        Detect all Spheros of self.profiles in the current frame
+        A tracked Sphero is searched only in a window around its predicted position,
+        the others and the lost ones in the whole frame with one colour table lookup
+        :return: dict profile name -> (x-Position, y-Position, radius) or None
+        """
+        startTime = now()
+        frameTime = self.frameTime if self.frameTime is not None else startTime
+        detections = {}
+        search = []
+        for name, config in self.profiles:
+            window = self.trackWindow(name, config, frameTime) if self.isTracking else None
+            if window is not None:
+                self.trackStats['roiSearches'] += 1
+                detections[name] = self.detectProfiles([(name, config)], window)[name]
+                if detections[name] is not None:
+                    continue
+                # Track lost - search the whole frame
+                self.trackStats['lost'] += 1
+            search.append((name, config))
+
+        if search:
+            self.trackStats['fullSearches'] += 1
+            detections.update(self.detectProfiles(search, (0, 0, self.frame.shape[1], self.frame.shape[0])))
+
+        for name, detection in detections.iteritems():
+            self.updateTrack(name, detection, frameTime)
+            if detection is not None:
+                if not self.isHeadless:
+                    # draw this circle
+                    cv2.circle(self.frame, (detection[0], detection[1]), 2, (0, 0, 255), 3)
+                coord = ([detection[0], detection[1], detection[2]])
+                if name == 'enemy':
+                    self.coordsEnemy = self.getPerspectivePosition(coord)
+                else:
+                    self.coordsMe = self.getPerspectivePosition(coord)
+
+        self.trackStats['frames'] += 1
+        self.trackStats['time'] += now() - startTime
+        return detections
+
+    def detectProfiles(self, profiles, window):
+        """
+        Detect Spheros in a window of the frame
+        The window is labelled for all profiles at once by the colour table,
+        the masks are filtered together as channels of one image
+        :param profiles: list of (name, config)
+        :param window: x, y, width, height in frame pixels
+        :return: dict profile name -> (x-Position, y-Position, radius) or None
+        """
+        x, y, w, h = window
+        image = self.frame[y:y + h, x:x + w]
+        # Working resolution of the mask
+        for level in range(self.vision['pyramid']):
+            image = cv2.pyrDown(image)
+        scale = 2 ** self.vision['pyramid']
+        labels = self.classify(image)
+        masks = [cv2.compare(cv2.bitwise_and(labels, self.profileBits[name]), 0, cv2.CMP_GT)
+                 for name, config in profiles]
+
+        # The filters run once for all profiles
+        mask = self.filterMask(cv2.merge(masks) if len(masks) > 1 else masks[0])
+        masks = cv2.split(mask) if len(masks) > 1 else [mask]
+
+        detections = {}
+        for (name, config), mask in zip(profiles, masks):
+            detections[name] = self.findSphero(mask, config, x, y, scale)
+        return detections
+
+    def filterMask(self, mask):
+        """
+        Remove noise from the colour mask as set in self.vision['filter']:
+        'legacy' - Gaussian blur, erode and dilate, 'open' - morphological opening,
+        'openclose' - opening then closing, 'none'
+        :param mask: mask at working resolution, one channel per profile
+        :return: filtered mask
+        """
+        method = self.vision['filter']
+        kernel = self.getKernel()
+        if method == 'legacy':
+            size = kernel.shape[0]
+            mask = cv2.GaussianBlur(mask, (size, size), 0)
+            mask = cv2.erode(mask, kernel)
+            return cv2.dilate(mask, kernel)
+        if method == 'open':
+            return cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
+        if method == 'openclose':
+            mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
+            return cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+        return mask
+
+    def getKernel(self):
+        """
+        Structuring element of the filter at working resolution, cached
+        :return: kernel of odd size, square of ones for 'legacy', ellipse otherwise
+        """
+        size = max(1, int(round(self.vision['kernel'] / 2.0 ** self.vision['pyramid']))) | 1
+        key = (size, self.vision['filter'] == 'legacy')
+        if key not in self.kernels:
+            if key[1]:
+                self.kernels[key] = np.ones((size, size), np.uint8)
             else:
-                self.coordsMe = self.getPerspectivePosition(coord)
+                self.kernels[key] = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (size, size))
+        return self.kernels[key]
 
-            return (int(center[1]), int(center[0]), radius)
+    def setVision(self, vision):
+        """
+        Set the detection preprocessing
+        :param vision: dict with 'pyramid' (pyrDown levels), 'filter' (see filterMask) and
+        'kernel' (filter size in full resolution pixels), missing keys keep the default
+        """
+        self.vision = dict(VISION_DEFAULT)
+        self.vision.update(vision or {})
 
-        return None
+    def classify(self, image):
+        """
+        Label the pixels of a BGR image with the colour table, no HSV conversion
+        Every pixel is read as one little endian 32 bit word b | g << 8 | r << 16, shifting and masking it
+        quantizes all channels at once into the index of the table
+        :param image: BGR image
+        :return: uint8 image, bit i set if the pixel fits the colour of self.profiles[i]
+        """
+        lut = self.colourTable()
+        index = cv2.cvtColor(image, cv2.COLOR_BGR2BGRA).view(np.uint32)[:, :, 0]
+        index >>= 8 - self.lutBits
+        index &= lutMask(self.lutBits)
+        return lut.take(index)
+
+    def colourTable(self):
+        """
+        Colour table of the current profiles, rebuilt only if a colour range changed
+        :return: BGR -> label table, see buildColourTable
+        """
+        key = tuple(tuple(config[k] for k in COLOUR_KEYS) for name, config in self.profiles)
+        if key != self.lutKey:
+            self.lut = buildColourTable([config for name, config in self.profiles], self.lutBits)
+            self.lutKey = key
+            self.profileBits = dict((name, 1 << i) for i, (name, config) in enumerate(self.profiles))
+        return self.lut
+
+    def findSphero(self, mask, config, offsetX=0, offsetY=0, scale=1):
+        """
+        Locate a Sphero in its filtered mask: the blob whose radius fits minRadius / maxRadius
+        of the config (0 - no limit), the largest one if several fit
+        :param mask: filtered mask of the profile
+        :param config: colour profile
+        :param offsetX: frame x of the mask's left column
+        :param offsetY: frame y of the mask's top row
+        :param scale: frame pixels per mask pixel
+        :return: x-Position, y-Position and radius in the frame or None
+        """
+        count, labels, stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=8)
+        if count < 2:
+            return None
+
+        # Label 0 is the background
+        stats = stats[1:]
+        radius = np.maximum(stats[:, cv2.CC_STAT_WIDTH], stats[:, cv2.CC_STAT_HEIGHT]) * scale / 2.0
+        fits = np.ones(len(radius), bool)
+        if config.get('minRadius'):
+            fits &= radius >= config['minRadius']
+        if config.get('maxRadius'):
+            fits &= radius <= config['maxRadius']
+        if not fits.any():
+            return None
+
+        area = np.where(fits, stats[:, cv2.CC_STAT_AREA], -1)
+        best = np.argmax(area)
+        # Centroid of the mask pixel centers in frame pixels
+        x, y = (centroids[best + 1] + 0.5) * scale - 0.5
+        return (int(x) + offsetX, int(y) + offsetY, radius[best])
+
+    def trackWindow(self, name, config, frameTime):
+        """
+        Search window around the predicted position of a tracked Sphero
+        Sized from the radius (config maxRadius, the measured one if 0), the
+        distance moved since the last frame and the filter kernel
+        :return: x, y, width, height in frame pixels or None if not tracked
+        """
+        track = self.tracks.get(name)
+        if track is None:
+            return None
+        x, y, radius, vx, vy, t = track
+        dt = max(0.0, frameTime - t)
+        x += vx * dt
+        y += vy * dt
+        reach = (config.get('maxRadius') or radius) + np.hypot(vx, vy) * dt * 1.5 + self.vision['kernel'] + 8
+        height, width = self.frame.shape[:2]
+        x0, y0 = max(0, int(x - reach)), max(0, int(y - reach))
+        x1, y1 = min(width, int(x + reach) + 1), min(height, int(y + reach) + 1)
+        if x1 <= x0 or y1 <= y0:
+            return None
+        return (x0, y0, x1 - x0, y1 - y0)
+
+    def updateTrack(self, name, detection, frameTime):
+        """
+        Update position and velocity in pixel/s of a tracked Sphero
+        """
+        if detection is None:
+            self.tracks[name] = None
+            return
+        x, y, radius = detection
+        vx = vy = 0.0
+        track = self.tracks.get(name)
+        if track is not None and frameTime > track[5]:
+            dt = frameTime - track[5]
+            # Smooth the velocity - the detected center jitters by a pixel or two
+            vx = 0.5 * track[3] + 0.5 * (x - track[0]) / dt
+            vy = 0.5 * track[4] + 0.5 * (y - track[1]) / dt
+        self.tracks[name] = (x, y, radius, vx, vy, frameTime)
+
+    def getTrackStats(self):
+        """
+        Tracking metrics
+        :return: dict with frames, ROI and full frame searches, track losses,
+        loss rate of the ROI searches and mean detection time per frame in seconds
+        """
+        stats = dict(self.trackStats)
+        stats['lossRate'] = float(stats['lost']) / stats['roiSearches'] if stats['roiSearches'] else 0.0
+        stats['frameTime'] = stats.pop('time') / stats['frames'] if stats['frames'] else None
+        return stats
 
     def getMouseclick(self, event, x, y, flags, param):
         """
@@ -227,6 +658,7 @@ class Opencv(threading.Thread):
 
         homoValue = ""
         homoXWorld = None
+        self.grabber.start()
         while (True):
             # get current positions of four trackbars
             config['cLowH'] = cv2.getTrackbarPos('LowH', 'image')
@@ -246,7 +678,11 @@ class Opencv(threading.Thread):
             upperColor = np.array([config['cHighH'], config['cHighS'], config['cHighV']])
 
             # Capture frame-by-frame
-            ret, frame = self.cap.read()
+            frame, self.frameTime = self.grabber.read()
+            if frame is None:
+                if self.grabber.isEnd:
+                    break
+                continue
             self.frame = frame[132:571, 170:672]
             #ret, self.frame = self.cap.read()
 
@@ -275,8 +711,9 @@ class Opencv(threading.Thread):
                 #cv2.imshow('frame', frame)
 
                 #print self.getPerspectivePosition(self.getPosition(0))
-                sphere = self.getPosition(1)
-                sphereEnemy = self.getPosition(0)
+                detections = self.detectAll()
+                sphere = detections['me']
+                sphereEnemy = detections['enemy']
 
                 retval = cv2.fitEllipse(self.ring)
 
@@ -406,7 +843,7 @@ class Opencv(threading.Thread):
                                         self.proportion = pixelDist / cmDist
 
         # When everything done, release the capture
-        self.cap.release()
+        self.grabber.stop()
         cv2.destroyAllWindows()
 
     def getMousePos(self, event, x, y, flags, param):
@@ -426,81 +863,235 @@ class Opencv(threading.Thread):
 def main():
     """
     Main Method
+    Optional argument: video file to use instead of the camera
+    'benchmark' and a video file: compare the detection methods
+    'accuracy', a video file and its label json: accuracy of the detection methods
+    'track', a video file and a json file: record the detected track for sphero_tracker.py
     """
     logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.DEBUG)
-    c = Opencv()
+    if len(sys.argv) > 2 and sys.argv[1] == 'benchmark':
+        benchmarkDetection(sys.argv[2])
+        return
+    if len(sys.argv) > 3 and sys.argv[1] == 'accuracy':
+        benchmarkAccuracy(sys.argv[2], sys.argv[3])
+        return
+    if len(sys.argv) > 3 and sys.argv[1] == 'track':
+        recordTrack(sys.argv[2], sys.argv[3])
+        return
+    c = Opencv(kwargs={'config': False, 'source': sys.argv[1] if len(sys.argv) > 1 else 0})
     c.run()
+    print(c.grabber.getStats())
+
+
+def lutMask(bits):
+    """
+    :return: mask of the quantized channels b | g << 8 | r << 16 in a 32 bit pixel
+    """
+    channel = (1 << bits) - 1
+    return channel | channel << 8 | channel << 16
+
 
-def calcDirection(x0, y1, x2, y2):
+def buildColourTable(configs, bits=6):
+    """
+    Precompute the colour classification of the quantized BGR cube
+    Every cell is tested with its center colour against the HSV ranges
+    :param configs: colour profiles, at most 8
+    :param bits: bits per channel, 5 -> 32x32x32 cells, 6 -> 64x64x64
+    :return: uint8 table indexed by b | (g << 8) | (r << 16) of the quantized
+    channels, bit i set if the colour fits configs[i] (the index keeps a byte per
+    channel, the unused entries stay 0)
+    """
+    size = 1 << bits
+    cells = np.arange(size)
+    blue, green, red = [cell.ravel() for cell in np.meshgrid(cells, cells, cells, indexing='ij')]
+    centers = np.dstack((blue, green, red)) << (8 - bits) | (1 << (7 - bits))
+    hsv = cv2.cvtColor(centers.astype(np.uint8), cv2.COLOR_BGR2HSV)
+    index = blue | green << 8 | red << 16
+    table = np.zeros(lutMask(bits) + 1, np.uint8)
+    for i, config in enumerate(configs):
+        mask = cv2.inRange(hsv, np.array([config['cLowH'], config['cLowS'], config['cLowV']]),
+                           np.array([config['cHighH'], config['cHighS'], config['cHighV']]))
+        table[index[mask.ravel() > 0]] |= 1 << i
+    return table
+
+
+def readFrames(source, frames):
     """
-    (NOT WORKING) Calculate angle between two given points in Degree
-    :param x1: X-Value of first Point
-    :param y1: Y-Value of first Point
-    :param x2: X-Value of second Point
-    :param y2: Y-Value of second Point
-    :return: current Direction of Sphero in Degree
+    Only for Development Tests - read the crops of recorded frames
+    :param source: video file
+    :param frames: maximal number of frames
+    :return: list of frames
     """
-    # Distance moved between points
-    distX = (x2 - x1)
-    distY = (y2 - y1)
-
-    ret = None
-    if distX != 0:
-        # calculate Angle of movement
-        ret = np.degrees(np.arctan(distY / distX))
-
-        # check 0° or 180°
-        if distX < 0 and distY == 0:
-            ret = 180
-    else:
-        # has Sphero moved or not
-        if distY != 0:
-            ret = 90
-
-    # add 360 if Angle is negative to get a positive result
-    if ret < 0:
-        if ret is None:
-            ret = None
-        else:
-            ret += 360
-    return ret
-
-
-def calculateSpeed(self, x1, y1, x2, y2, time1, time2):
+    cap = cv2.VideoCapture(source)
+    recorded = []
+    while len(recorded) < frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        recorded.append(frame[132:571, 170:672])
+    cap.release()
+    return recorded
+
+
+def formerPosition(frame, config, kernel=np.ones((15, 15), np.uint8)):
     """
-    (NOT WORKING) Calculate Speed based on two given Points
-    :param x1: X-Value of first Point
-    :param y1: Y-Value of first Point
-    :param x2: X-Value of second Point
-    :param y2: Y-Value of second Point
-    :param time1: Timestamp of first frame
-    :param time2: Timestamp of second frame
-    :return: current Speed in cm/s (int)
+    Only for Development Tests - the former getPosition: minEnclosingCircle over every mask pixel
+    :return: x-Position, y-Position and radius or None
     """
+    imgHSV = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
+    mask = cv2.inRange(imgHSV, np.array([config['cLowH'], config['cLowS'], config['cLowV']]),
+                       np.array([config['cHighH'], config['cHighS'], config['cHighV']]))
+    cv2.bitwise_and(frame, frame, mask=mask)
+    mask = cv2.GaussianBlur(mask, (15, 15), 0)
+    mask = cv2.erode(mask, kernel)
+    mask = cv2.dilate(mask, kernel)
+    points = np.dstack(np.where(mask > 0)).astype(np.float32)
+    if len(points[0]) > 0:
+        center, radius = cv2.minEnclosingCircle(points)
+        return (int(center[1]), int(center[0]), radius)
+    return None
 
-    # calculate vector between points
-    d_x = x2
-    d_x -= x1
-    d_y = y2
-    d_y -= y1
 
-    # calculate lengths of Distancevector
-    distance = np.power(d_x, 2)
-    distance += np.power(d_y, 2)
-    distance = np.sqrt(distance)
-    distance /= self.proportion
+# Preprocessing settings compared by benchmarkAccuracy
+VISION_BENCHMARK = [{'pyramid': pyramid, 'filter': method, 'kernel': kernel}
+                    for pyramid in (0, 1, 2) for method, kernel in (('legacy', 15), ('open', 9), ('openclose', 9))]
 
-    # calculate difference between Timestamps
-    time = time1
-    time -= time2
-    time /= 1000
 
-    # calculate Speed in cm/s
-    speed = distance
-    speed /= float(time)
+def benchmarkAccuracy(source, labelFile, frames=1000):
+    """
+    Only for Development Tests - accuracy and full frame speed of the former detection and of
+    detectAll with the preprocessing settings of VISION_BENCHMARK on labelled frames
+    :param source: recorded video file
+    :param labelFile: json {"frame number": {"me": [x, y] or null, "enemy": [x, y] or null}}
+    in pixels of the crop
+    :param frames: maximal number of frames
+    """
+    recorded = readFrames(source, frames)
+    with open(labelFile, 'rb') as fp:
+        labels = dict((int(number), label) for number, label in json.load(fp).iteritems())
+    # The grabber of c is never started
+    c = Opencv(kwargs={'source': source, 'tracking': False})
+
+    def score(name, detect):
+        errors = []
+        misses = falses = 0
+        start = now()
+        for number, frame in enumerate(recorded):
+            if number not in labels:
+                continue
+            found = detect(frame)
+            for robot, truth in labels[number].iteritems():
+                if truth is None:
+                    falses += found[robot] is not None
+                elif found[robot] is None:
+                    misses += 1
+                else:
+                    errors.append(np.hypot(found[robot][0] - truth[0], found[robot][1] - truth[1]))
+        elapsed = (now() - start) / max(1, len([n for n in labels if n < len(recorded)]))
+        print("%-28s error mean: %6.2f px  max: %6.2f px  missed: %d  false: %d  %.2f ms/frame"
+              % (name, np.mean(errors) if errors else 0, np.max(errors) if errors else 0, misses, falses,
+                 elapsed * 1000))
+
+    def detectFormer(frame):
+        return dict(me=formerPosition(frame, c.me), enemy=formerPosition(frame, c.enemy))
+
+    def detectNew(frame):
+        c.frame = frame.copy()
+        return c.detectAll()
+
+    score("former", detectFormer)
+    for vision in VISION_BENCHMARK:
+        c.setVision(vision)
+        score("pyramid %(pyramid)d %(filter)s %(kernel)d" % c.vision, detectNew)
+
+
+def benchmarkDetection(source, frames=200):
+    """
+    Only for Development Tests - per frame cost of detectAll with and without
+    tracking against the former detection (HSV conversion and filters per
+    getPosition call, 2.25 calls per frame), track loss rate
+    :param source: recorded video file
+    :param frames: number of frames to use
+    """
+    recorded = readFrames(source, frames)
+    if not recorded:
+        print("No frames in " + str(source))
+        return
+
+    # The grabber of c is never started
+    c = Opencv(kwargs={'source': source})
+
+    start = now()
+    for i, frame in enumerate(recorded):
+        formerPosition(frame, c.me)
+        formerPosition(frame, c.enemy)
+        if i % 8 in (0, 7):
+            formerPosition(frame, c.enemy)
+    former = (now() - start) / len(recorded)
+
+    # Recorded frame times for the tracking
+    fps = cv2.VideoCapture(source).get(CV_CAP_PROP_FRAME_RATE) or 30.0
+    results = {}
+    for c.isTracking in (False, True):
+        c.tracks = {}
+        c.trackStats = dict(frames=0, roiSearches=0, fullSearches=0, lost=0, time=0.0)
+        for i, frame in enumerate(recorded):
+            c.frame = frame.copy()
+            c.frameTime = i / fps
+            c.detectAll()
+        results[c.isTracking] = c.getTrackStats()
+
+    print("Frames: %d  former: %.2f ms/frame" % (len(recorded), former * 1000))
+    print("detectAll full frame: %.2f ms/frame  speedup: %.1fx"
+          % (results[False]['frameTime'] * 1000, former / results[False]['frameTime']))
+    print("detectAll tracking: %.2f ms/frame  speedup: %.1fx  track loss rate: %.3f  full searches: %d"
+          % (results[True]['frameTime'] * 1000, former / results[True]['frameTime'], results[True]['lossRate'],
+             results[True]['fullSearches']))
+
+
+def recordTrack(source, trackFile, frames=100000):
+    """
+    Only for Development Tests - detect both Spheros in every frame of a video and save their
+    world positions with the frame times, replay it with sphero_tracker.py trackFile
+    :param source: recorded video file
+    :param trackFile: json file to write
+    :param frames: maximal number of frames
+    """
+    cap = cv2.VideoCapture(source)
+    fps = cap.get(CV_CAP_PROP_FRAME_RATE) or 30.0
+    # The grabber of c is never started
+    c = Opencv(kwargs={'source': source, 'headless': True})
+    track = []
+    while len(track) < frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        c.frame = frame[132:571, 170:672]
+        c.frameTime = len(track) / fps
+        detections = c.detectAll()
+        track.append((c.frameTime, {'me': c.coordsMe if detections['me'] else None,
+                                    'enemy': c.coordsEnemy if detections['enemy'] else None}))
+    cap.release()
+    saveTrack(trackFile, track)
+    print("%d frames written to %s" % (len(track), trackFile))
+
+
+def saveTrack(path, track):
+    """
+    Save a track for sphero_tracker.loadTrack
+    :param path: json file
+    :param track: list of (time, dict name -> world position or None)
+    """
+    with open(path, 'wb') as fp:
+        json.dump([(t, dict((name, [float(v) for v in position[:2]] if position is not None else None)
+                            for name, position in frame.iteritems())) for t, frame in track], fp)
 
-    return speed
 
+def now():
+    """
+    Monotonic time in seconds from the OpenCV tick counter
+    """
+    return cv2.getTickCount() / cv2.getTickFrequency()
 
 def saveConfig(name, config):
     """
@@ -516,23 +1107,6 @@ def saveConfig(name, config):
         json.dump(config, fp)
 
 
-def loadConfig(name):
-    """
-    load Configuration from json
-    :param name: Filename
-    :return: Configuration-Data
-    """
-    # Set Path
-    path = 'config/' + name + '.json'
-    # load json-File
-    if os.path.isfile(path):
-        with open(path, 'rb') as fp:
-            data = json.load(fp)
-
-        return data
-    return None
-
-
 def saveHomo(name, homo):
     """
     save Homography Configuration in json File
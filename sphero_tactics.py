@@ -3,7 +3,9 @@ import threading
 import time
 
 import numpy as np
+import sphero_collision
 import sphero_control
+from sphero_driver import sphero_macro
 import pygame
 from pygame.locals import *
 
@@ -27,6 +29,7 @@ class Tactics(threading.Thread):
         # Get the Opencv Object
         self.openCv = kwargs['openCv']
         self.sphero = sphero_control.Control()
+        self.collision = sphero_collision.Collision(self.sphero)
 
         self.logger = logging.getLogger('sphero.tactics')
 
@@ -49,8 +52,12 @@ class Tactics(threading.Thread):
         self.clock = None
         self.waitFor = None
         self.tac2_goToTac = 1
-        self.tac3_gotoPunkt = 0
+        self.tac1_pushUntil = None
+        self.tac1_pushGrad = 0
         self.tac3_waitFor = None
+        self.tac3_loopUntil = None
+        self.tac4_evadeUntil = None
+        self.tac4_evadeGrad = 0
 
 
     def run(self):
@@ -85,9 +92,9 @@ class Tactics(threading.Thread):
         while (not self.threadExit):
             background.fill((250, 250, 250))
 
-            # Get Coordinates form the OpenCv Thread
-            coordsEnemy = self.openCv.coordsEnemy
-            coordsMe = self.openCv.coordsMe
+            # Positions when the commands of this tick arrive at Sphero
+            self.openCv.linkLatency = self.sphero.getCommandLatency()
+            coordsEnemy, coordsMe = self.getCoords()
 
             speedMe = self.openCv.speedMe
             speedEnemy = self.openCv.speedEnemy
@@ -133,21 +140,22 @@ class Tactics(threading.Thread):
                 # Game Start
                 if event.key == K_SPACE:
                     self.logger.error("Game Start")
-                    self.actTactic = 1
+                    self.switchTactic(1)
                     self.isGameRunning = True
 
                 # Game Stop
                 elif event.key == K_RETURN:
+                    self.switchTactic(0)
                     self.sphero.stop()
                     self.isGameRunning = False
 
                 # Change Tactic manual
                 elif event.key == K_a:
-                    self.actTactic = 0
+                    self.switchTactic(0)
                 elif event.key == K_s:
-                    self.actTactic = 1
+                    self.switchTactic(1)
                 elif event.key == K_d:
-                    self.actTactic = 2
+                    self.switchTactic(2)
 
                 # Control Sphero manual
                 elif event.key == K_RIGHT:
@@ -165,12 +173,14 @@ class Tactics(threading.Thread):
                     self.sphero.setColor(2)
                     self.sphero.setBackled(True)
                     self.sphero.setRoataionRate(255)
+                    self.collision.enable()
                 # Connect to Sphero 2 and set game settings
                 elif event.key == K_2:
                     self.sphero.connect(1)
                     self.sphero.setColor(2)
                     self.sphero.setBackled(True)
                     self.sphero.setRoataionRate(255)
+                    self.collision.enable()
                 # Change Sphero color - Red
                 elif event.key == K_8:
                     self.sphero.setColor(0)
@@ -195,14 +205,21 @@ class Tactics(threading.Thread):
                 elif event.key == K_ESCAPE:
                     self.threadExit = True
 
+            # Collisions are felt before the camera sees them - react in this tick
+            event = self.collision.poll()
+
             # Call the current tactic if game is running
             if self.isGameRunning:
 
                 if self.isGameOver():
+                    self.switchTactic(0)
                     self.tactic0()
-                    self.actTactic = 0
                     self.isGameRunning = False
 
+                elif event:
+                    # Preempt the current tactic
+                    self.onCollision(event)
+
                 else:
                     # Call tactic
                     self.tactics[self.actTactic][0]()
@@ -227,10 +244,15 @@ class Tactics(threading.Thread):
         # me weiter aussen als gegener -> taktic goHome()
         # sonst weiter schieben
 
-        # Get coordinates form OpenCv thread if available
-        if self.openCv.coordsEnemy and self.openCv.coordsMe:
-            coordsEnemy = self.openCv.coordsEnemy
-            coordsMe = self.openCv.coordsMe
+        # Push on after a collision until the push time is over
+        if self.tac1_pushUntil is not None:
+            if time.time() < self.tac1_pushUntil:
+                self.sphero.roll(self.collision.config['pushSpeed'], self.tac1_pushGrad)
+                return
+            self.tac1_pushUntil = None
+
+        # Get the predicted coordinates form OpenCv thread
+        coordsEnemy, coordsMe = self.getCoords()
         gotoGrad = 0
 
         if coordsEnemy and coordsMe:
@@ -275,7 +297,6 @@ class Tactics(threading.Thread):
                     self.tac2_goToTac = 1
                 else:
                     self.actTactic = 3
-                    self.tac3_gotoPunkt = 0
                     self.tac2_goToTac = 3
 
         # Home not reached
@@ -285,35 +306,87 @@ class Tactics(threading.Thread):
     def tactic3(self):
         """
         Tactic 3: Kreisen
+        Drive to the circle around the ring centre with the camera, then one loop runs as macro on Sphero -
+        no roll commands over the link. After every loop the position is checked again.
         """
+        # Circle radius around the ring centre, distance to the circle to start a loop
+        kreisRadius = 60
+        abstand = 15
 
-        # Points form the Circle to reache
-        kreisPunkte = ((0, 60), (-60, 0), (0, -60), (60, 0))
-
-        # Check if position is available
-        if self.openCv.coordsMe:
-            coordsMe = self.openCv.coordsMe
-
-            # Go to circle position and if it near enough go to next position
-            if self.goToPosition(coordsMe, kreisPunkte[self.tac3_gotoPunkt], 70, 50):
-                # Go to next circle position
-                self.tac3_gotoPunkt = (self.tac3_gotoPunkt + 1) % 4
-
-                # Do Circling for 5.5 sec then change tactic
+        # Do Circling for 5.5 sec then change tactic
+        now = int(time.time() * 1000)
         if self.tac3_waitFor is None:
-            self.tac3_waitFor = int(time.time() * 1000) + 5500
+            self.tac3_waitFor = now + 5500
 
         # Timer end - go to new tactic
-        elif int(time.time() * 1000) >= self.tac3_waitFor:
-            self.tac3_waitFor = None
-            self.actTactic = 1
-
+        elif now >= self.tac3_waitFor:
+            self.switchTactic(1)
+            return
+
+        # Loop running on Sphero
+        if self.tac3_loopUntil is not None:
+            if now < self.tac3_loopUntil:
+                return
+            self.tac3_loopUntil = None
+
+        coordsEnemy, coordsMe = self.getCoords()
+        if not coordsMe:
+            return
+
+        # Go to the nearest point of the circle, then start a loop heading along the circle
+        coordRad, coordGrad = cart2pol(coordsMe[0], coordsMe[1])
+        kreisPunkt = pol2cart(kreisRadius, np.radians(coordGrad))
+        if self.goToPosition(coordsMe, kreisPunkt, 70, abstand):
+            self.sphero.runMacro(sphero_macro.circle(70, 2750, 12, 1, (450 - coordGrad) % 360))
+            self.tac3_loopUntil = now + 2750
 
     def tactic4(self):
         """
         Tactic 4: Ausweichen wenn gegner mit voller geschwindigkeit kommt, aufpassen auf die Raender  30 > r < 70
+        Drive away from the last impact, then go home
+        """
+        if self.tac4_evadeUntil is None or time.time() >= self.tac4_evadeUntil:
+            self.tac4_evadeUntil = None
+            self.actTactic = 2
+        else:
+            self.sphero.roll(self.collision.config['evadeSpeed'], self.tac4_evadeGrad)
+
+    def onCollision(self, event):
+        """
+        React to a collision event of Sphero
+        Pushing: push on with full speed for pushTime, otherwise evade away from the impact
+        """
+        speed, heading = self.sphero.getRoll()
+        if self.actTactic == 1:
+            self.tac1_pushGrad = heading
+            self.tac1_pushUntil = time.time() + self.collision.config['pushTime']
+            self.tactic1()
+        else:
+            self.tac4_evadeGrad = (self.collision.impactHeading(event, heading) + 180) % 360
+            self.tac4_evadeUntil = time.time() + self.collision.config['evadeTime']
+            self.switchTactic(4)
+            self.tactic4()
+        self.collision.reacted(event)
+
+    def switchTactic(self, tactic):
+        """
+        Switch to a new tactic, a circling loop of tactic 3 is aborted and its timers reset
+        """
+        if self.tac3_loopUntil is not None:
+            self.sphero.abortMacro()
+        self.tac3_waitFor = None
+        self.tac3_loopUntil = None
+        self.actTactic = tactic
+
+    def getCoords(self):
+        """
+        Positions of both Spheros predicted to the arrival of a command given now,
+        the last detection if a Sphero is not tracked
+        :returns coordsEnemy, coordsMe - (x, y) in cm or None
         """
-        pass
+        coordsEnemy = self.openCv.predict('enemy') or self.openCv.coordsEnemy
+        coordsMe = self.openCv.predict('me') or self.openCv.coordsMe
+        return coordsEnemy, coordsMe
 
     def goToPosition(self, coordXY, coordTargetXY, speed, abstand):
         """
@@ -0,0 +1,205 @@
+import json
+import logging
+import sys
+
+import numpy as np
+
+
+class KalmanTracker(object):
+    """Constant velocity Kalman filter for all Spheros at once:
+        - State per robot: x, y in cm and vx, vy in cm/s in world coordinates
+        - Updated on every detection with the capture time of the frame
+        - One vectorized predict / update step for all robots
+    """
+
+    def __init__(self, names, accelNoise=150.0, measureNoise=1.5, lostTime=1.0):
+        """
+        :param names: robot names, e.g. ('enemy', 'me')
+        :param accelNoise: standard deviation of the unmodelled acceleration in cm/s^2
+        :param measureNoise: standard deviation of a detected position in cm
+        :param lostTime: seconds without detection after which a track is dropped
+        """
+        self.logger = logging.getLogger('sphero.tracker')
+        self.names = list(names)
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+        self.accelNoise = accelNoise
+        self.measureNoise = measureNoise
+        self.lostTime = lostTime
+
+        n = len(self.names)
+        # The state is replaced as a whole - readers in other threads see one consistent snapshot
+        self.state = (np.zeros(n), np.zeros((n, 4)), np.zeros((n, 4, 4)), np.zeros(n, bool))
+
+    def update(self, t, measurements):
+        """
+        Predict all tracks to time t and correct them with the detections
+        :param t: capture time of the frame in seconds
+        :param measurements: dict name -> (x, y) in cm or None if not detected
+        """
+        times, x, P, valid = self.state
+        x = x.copy()
+        P = P.copy()
+        times = times.copy()
+        valid = valid & (t - times <= self.lostTime)
+
+        z = np.zeros((len(self.names), 2))
+        seen = np.zeros(len(self.names), bool)
+        for name, position in measurements.iteritems():
+            if position is not None and name in self.index:
+                z[self.index[name]] = position
+                seen[self.index[name]] = True
+
+        # Start new tracks at the detection, at rest with a large speed uncertainty
+        new = seen & ~valid
+        x[new, :2] = z[new]
+        x[new, 2:] = 0.0
+        P[new] = np.diag([self.measureNoise ** 2] * 2 + [100.0 ** 2] * 2)
+        times[new] = t
+
+        step = seen & valid
+        if step.any():
+            dt = t - times[step]
+            F, Q = self.transition(dt)
+            xs = np.einsum('nij,nj->ni', F, x[step])
+            Ps = np.einsum('nij,njk,nlk->nil', F, P[step], F) + Q
+
+            # Measurement of the position: H = [I 0]
+            S = Ps[:, :2, :2] + np.eye(2) * self.measureNoise ** 2
+            K = np.einsum('nij,njk->nik', Ps[:, :, :2], np.linalg.inv(S))
+            xs += np.einsum('nij,nj->ni', K, z[step] - xs[:, :2])
+            Ps -= np.einsum('nij,njk->nik', K, Ps[:, :2, :])
+            x[step] = xs
+            P[step] = Ps
+            times[step] = t
+
+        self.state = (times, x, P, valid | seen)
+
+    def transition(self, dt):
+        """
+        Constant velocity model for the time steps dt
+        :param dt: array of time steps in seconds
+        :return: transition matrices F and process noise Q, shape (len(dt), 4, 4)
+        """
+        n = len(dt)
+        F = np.tile(np.eye(4), (n, 1, 1))
+        F[:, 0, 2] = F[:, 1, 3] = dt
+        # White acceleration noise
+        q = self.accelNoise ** 2
+        Q = np.zeros((n, 4, 4))
+        Q[:, 0, 0] = Q[:, 1, 1] = q * dt ** 4 / 4
+        Q[:, 0, 2] = Q[:, 2, 0] = Q[:, 1, 3] = Q[:, 3, 1] = q * dt ** 3 / 2
+        Q[:, 2, 2] = Q[:, 3, 3] = q * dt ** 2
+        return F, Q
+
+    def getState(self, name):
+        """
+        Current estimate of a robot
+        :param name: robot name
+        :return: dict with time, position (x, y) in cm, velocity (vx, vy) in cm/s, speed in cm/s,
+        heading in degrees 0 - 360 as cart2pol and the 4x4 covariance, or None if not tracked
+        """
+        times, x, P, valid = self.state
+        i = self.index[name]
+        if not valid[i]:
+            return None
+        vx, vy = x[i, 2:]
+        heading = np.degrees(np.arctan2(vy, vx))
+        return dict(time=times[i], position=(x[i, 0], x[i, 1]), velocity=(vx, vy), speed=np.hypot(vx, vy),
+                    heading=heading + 360 if heading < 0 else heading, covariance=P[i])
+
+    def predict(self, name, t):
+        """
+        Extrapolate a robot to time t with the constant velocity model, the state is not changed
+        :param name: robot name
+        :param t: time in seconds of the same clock as update
+        :return: dict with time, position (x, y) in cm, velocity (vx, vy) in cm/s, horizon in seconds
+        from the last detection and the 4x4 covariance, or None if not tracked at t
+        """
+        times, x, P, valid = self.state
+        i = self.index[name]
+        dt = t - times[i]
+        if not valid[i] or dt > self.lostTime:
+            return None
+        dt = max(0.0, dt)
+        F, Q = self.transition(np.array([dt]))
+        xp = F[0].dot(x[i])
+        return dict(time=t, position=(xp[0], xp[1]), velocity=(xp[2], xp[3]), horizon=dt,
+                    covariance=F[0].dot(P[i]).dot(F[0].T) + Q[0])
+
+
+def loadTrack(path):
+    """
+    Read a recorded track, see sphero_opencv.Opencv (kwargs recordTrack) and sphero_opencv.recordTrack
+    :param path: json file [[time, {"me": [x, y] or null, "enemy": [x, y] or null}], ...]
+    :return: list of (time, dict name -> (x, y) or None)
+    """
+    with open(path, 'rb') as fp:
+        return [(t, dict((name, tuple(position) if position else None) for name, position in frame.iteritems()))
+                for t, frame in json.load(fp)]
+
+
+def evaluatePrediction(track, horizons=(0.033, 0.066, 0.1, 0.2, 0.3), maxGap=0.1, **kwargs):
+    """
+    Only for Development Tests - replay a recorded track through a KalmanTracker and compare
+    the predictions for every horizon with the later recorded positions
+    The truth at t + horizon is interpolated between the two detections around it,
+    skipped if they are more than maxGap seconds apart
+    :param track: list of (time, dict name -> (x, y) or None) as loadTrack
+    :param horizons: prediction horizons in seconds
+    :param kwargs: parameters of KalmanTracker
+    :return: dict (name, horizon) -> dict with count, mean, p95 and max error of the prediction
+    and mean error of the last detection (no compensation) in cm
+    """
+    names = sorted(set(name for t, frame in track for name in frame))
+    tracker = KalmanTracker(names, **kwargs)
+    # Detections per robot: times and positions for the interpolation of the truth
+    seen = {}
+    for name in names:
+        points = [(t, frame[name]) for t, frame in track if frame.get(name) is not None]
+        seen[name] = (np.array([t for t, p in points]), np.array([p for t, p in points], float).reshape(-1, 2))
+
+    errors = dict(((name, h), ([], [])) for name in names for h in horizons)
+    last = {}
+    for t, frame in track:
+        tracker.update(t, frame)
+        for name in names:
+            if frame.get(name) is not None:
+                last[name] = frame[name]
+            times, positions = seen[name]
+            for h in horizons:
+                k = np.searchsorted(times, t + h)
+                if k == 0 or k >= len(times) or times[k] - times[k - 1] > maxGap:
+                    continue
+                prediction = tracker.predict(name, t + h)
+                if prediction is None or name not in last:
+                    continue
+                w = (t + h - times[k - 1]) / (times[k] - times[k - 1])
+                truth = positions[k - 1] + w * (positions[k] - positions[k - 1])
+                errors[name, h][0].append(np.hypot(*(np.array(prediction['position']) - truth)))
+                errors[name, h][1].append(np.hypot(*(np.array(last[name]) - truth)))
+
+    results = {}
+    for key, (predicted, held) in errors.iteritems():
+        if predicted:
+            results[key] = dict(count=len(predicted), mean=np.mean(predicted), p95=np.percentile(predicted, 95),
+                                max=np.max(predicted), heldMean=np.mean(held))
+    return results
+
+
+def main():
+    """
+    Only for Development Tests - prediction error of a recorded track
+    Argument: track json of sphero_opencv.recordTrack or Opencv kwargs recordTrack
+    """
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    if len(sys.argv) < 2:
+        print("Usage: sphero_tracker.py <track.json>")
+        return
+    results = evaluatePrediction(loadTrack(sys.argv[1]))
+    for name, h in sorted(results):
+        r = results[name, h]
+        print("%-6s %4d ms  n: %4d  error mean: %5.2f cm  p95: %5.2f cm  max: %5.2f cm  last detection: %5.2f cm"
+              % (name, h * 1000, r['count'], r['mean'], r['p95'], r['max'], r['heldMean']))
+
+if __name__ == '__main__':
+    main()